@@ -34,7 +34,8 @@ basic synchronization, and Mailfile's sister project, Mailpile
 
 Other storage solutions that present the same API as Python's imaplib should
 work as well. Included is one such solution, `backends.FilesystemIMAP`, which
-reads/writes from files on disk using a variant of the Maildir format.
+reads/writes from files on disk using a variant of the Maildir format, and
+`backends.SQLiteIMAP`, which keeps everything in a single SQLite database.
 
 See the doc-strings for `Mailfile.synchronize` for a description of the
 protocol itself and `Mailfile.encode_object` to read about the message format
@@ -42,29 +43,152 @@ in IMAP.
 """
 
 import base64
+import collections
 import copy
 import email.parser
+import functools
 import hashlib
+import heapq
+import imaplib
+import io
+import itertools
 import json
 import os
 import re
+import socket
 import stat
+import struct
 import threading
 import time
+import weakref
 import zlib
 
-from StringIO import StringIO
 from base64 import urlsafe_b64encode
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.hmac import HMAC
+
+try:
+    import ujson
+    # Older releases only parse floats exactly when asked to.
+    _json_loads = functools.partial(ujson.loads, precise_float=True)
+    _json_loads('0')
+except (ImportError, TypeError):
+    _json_loads = json.loads
+
+
+def _json_dumps(obj, default=None):
+    """
+    Compact JSON for metadata and snapshots. This always uses the stdlib:
+    ujson on Python 2 truncates floats and escapes strings differently,
+    which would silently change user metadata.
+
+    >>> md = {u'f': 0.1 + 0.2, u'u': u'\\xe9\\u2603', u'p': u'/a/"b"\\n'}
+    >>> _json_loads(_json_dumps(md)) == md
+    True
+    """
+    return json.dumps(obj, separators=(',', ':'), default=default)
+
+
+# Bodies larger than this are encrypted using _fernet_encrypt, which feeds
+# the cipher in _CIPHER_CHUNK_BYTES slices instead of padding a full copy.
+_LARGE_BODY_BYTES = 64 * 1024
+_CIPHER_CHUNK_BYTES = 16 * 1024
+
+# Padding used to hide the exact size of encrypted metadata and files.
+_METADATA_PADDING = '_' * 148
+_DATA_PADDING = ' ' * 2048
+
+_FETCH_UID_RE = re.compile(r'\bUID (\d+)')
+_MULTISLASH_RE = re.compile(r'//+')
+_WHITESPACE = b' \t\r\n'
+_HEADER_END_RE = re.compile(r'\r?\n\r?\n')
+_HEADER_PARSER = email.parser.HeaderParser()
+_FULL_PARSER = email.parser.Parser()
+_X_MAILFILE_RE = re.compile(r'(?mi)^X-Mailfile:(.*(?:\r?\n[ \t].*)*)')
+
+
+def _fernet_encrypt(key, data, suffix=b''):
+    """
+    Create a Fernet token, exactly as `Fernet(key).encrypt(data + suffix)`
+    would, but using the OpenSSL cipher primitives directly. The plaintext
+    is fed to the (AES-NI accelerated, where available) cipher in blocks,
+    so we never make a padded copy of the whole thing.
+    """
+    key = base64.urlsafe_b64decode(key)
+    iv = os.urandom(16)
+    backend = default_backend()
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    encryptor = Cipher(
+        algorithms.AES(key[16:]), modes.CBC(iv), backend).encryptor()
+    token = [b'\x80', struct.pack('>Q', int(time.time())), iv]
+    for i in range(0, len(data), _CIPHER_CHUNK_BYTES):
+        token.append(encryptor.update(
+            padder.update(data[i:i + _CIPHER_CHUNK_BYTES])))
+    token.append(encryptor.update(padder.update(suffix) + padder.finalize()))
+    token.append(encryptor.finalize())
+    token = b''.join(token)
+    hmac = HMAC(key[:16], hashes.SHA256(), backend)
+    hmac.update(token)
+    return base64.urlsafe_b64encode(token + hmac.finalize())
+
+
+_FERNETS = {}
+
+
+def _make_fernet(key):
+    """
+    Return a Fernet object for a (derived) key, reusing the ones we made
+    before so switching back and forth between keys is cheap.
+    """
+    fernet = _FERNETS.get(key)
+    if fernet is None:
+        if len(_FERNETS) >= 8:
+            _FERNETS.clear()
+        fernet = _FERNETS[key] = Fernet(key)
+    return fernet
+
+
+_CLEAN_PATHS = {}
 
 
 def _clean_path(path):
-    while path[:1] == '/':
-        path = path[1:]
-    while path[-1:] == '/':
-        path = path[:-1]
-    return path.replace('//', '/')
+    # The same few paths tend to get looked up over and over (FUSE stats
+    # everything it sees), so remember the results.
+    clean = _CLEAN_PATHS.get(path)
+    if clean is None:
+        if len(_CLEAN_PATHS) >= 4096:
+            _CLEAN_PATHS.clear()
+        clean = _CLEAN_PATHS[path] = _MULTISLASH_RE.sub('/', path.strip('/'))
+    return clean
+
+
+def _compress_uid_set(uids):
+    """Render a sorted list of UIDs as an IMAP sequence set: 1:3,5,7:8"""
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(
+        ('%d' % a) if (a == b) else ('%d:%d' % (a, b)) for a, b in ranges)
+
+
+def _wrap(data, width=78, indent='', prefix=''):
+    # Our encoded data (base64 or Fernet tokens) never contains whitespace,
+    # so folding it is just a matter of slicing. The prefix is added to the
+    # first line, rather than copying all the data just to prepend it.
+    first = width - len(prefix)
+    return indent + ('\r\n' + indent).join(itertools.chain(
+        [prefix + data[:first]],
+        (data[i:i + width] for i in range(first, len(data), width))))
 
 
 def _clean_metadata(metadata):
@@ -74,10 +198,150 @@ def _clean_metadata(metadata):
     return metadata
 
 
-class Mailfile_File(StringIO):
+class _LockSide(object):
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class _RWLock(object):
+    """
+    A readers/writer lock: any number of threads may hold the `reader` side
+    at once, but the `writer` side is exclusive (and re-entrant). The thread
+    holding the writer may also take the reader, but a thread holding only
+    the reader must never try to upgrade to the writer.
     """
-    This class presents a file-like interface (based on StringIO) to a file
-    stored in Mailfile.
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self.reader = _LockSide(self.acquire_read, self.release_read)
+        self.writer = _LockSide(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        with self._cond:
+            while self._writer not in (None, me):
+                self._cond.wait()
+            self._readers += 1
+        return True
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is not me:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._writer = me
+            self._writer_depth += 1
+        return True
+
+    def release_write(self):
+        with self._cond:
+            if self._writer is not threading.current_thread():
+                raise RuntimeError('Cannot release un-acquired lock')
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    def acquire_other(self, lock):
+        """
+        Acquire some other lock. If this thread holds our writer side, it
+        is released while we wait and taken back afterwards, so threads
+        holding that lock can still get ours. Callers must be able to cope
+        with other threads having run in the meantime.
+        """
+        if lock.acquire(False):
+            return True
+        me = threading.current_thread()
+        with self._cond:
+            depth = self._writer_depth if (self._writer is me) else 0
+            if depth:
+                self._writer, self._writer_depth = None, 0
+                self._cond.notify_all()
+        try:
+            lock.acquire()
+        finally:
+            if depth:
+                self.acquire_write()
+                with self._cond:
+                    self._writer_depth = depth
+        return True
+
+
+class _DeflateStream(object):
+    """
+    Raw DEFLATE (RFC 4978) framing for an IMAP socket. The read, readline
+    and send methods replace those of an imaplib.IMAP4 object once the
+    server has agreed to COMPRESS=DEFLATE.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        # Unread data starts at buffer[offset:], and buffer[:scanned] is
+        # known to hold no newlines; this keeps large literals linear.
+        self.buffer = bytearray()
+        self.offset = self.scanned = 0
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def _fill(self):
+        while True:
+            data = self.sock.recv(16384)
+            if not data:
+                raise imaplib.IMAP4.abort('Socket closed')
+            data = self.decompressor.decompress(data)
+            if data:
+                if self.offset > len(self.buffer) // 2:
+                    del self.buffer[:self.offset]
+                    self.scanned -= self.offset
+                    self.offset = 0
+                self.buffer += data
+                return
+
+    def _take(self, end):
+        data = bytes(self.buffer[self.offset:end])
+        self.offset = end
+        return data
+
+    def read(self, size):
+        while len(self.buffer) - self.offset < size:
+            self._fill()
+        return self._take(self.offset + size)
+
+    def readline(self):
+        while True:
+            eol = self.buffer.find(b'\n', max(self.offset, self.scanned))
+            if eol >= 0:
+                return self._take(eol + 1)
+            self.scanned = len(self.buffer)
+            self._fill()
+
+    def send(self, data):
+        self.sock.sendall(
+            self.compressor.compress(data) +
+            self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+class Mailfile_File(io.BytesIO):
+    """
+    This class presents a file-like interface (based on io.BytesIO) to a file
+    stored in Mailfile. File contents are bytes.
 
     All operations are in RAM until the file is closed, at which point (if
     the file was opened in a writable mode), the contents will be written
@@ -96,38 +360,43 @@ class Mailfile_File(StringIO):
     garbage collection.
     """
     def __init__(self, mailfile, file_path, mode, metadata, *args, **kwargs):
-        StringIO.__init__(self, *args, **kwargs)
+        io.BytesIO.__init__(self, *args, **kwargs)
         self._file_path = file_path
         self._open_mode = mode
         self._mailfile = mailfile
-        self._lock = mailfile._lock
+        self._lock = mailfile._path_lock(file_path)
+        self._rwlock = mailfile._rwlock
         self._metadata = metadata
 
     file_path = property(lambda self: self._file_path)
     metadata = property(lambda self: self._metadata)
 
     def __enter__(self, *args, **kwargs):
-        self._lock.acquire()
+        self._rwlock.acquire_other(self._lock)
         return self
 
     def __exit__(self, *args, **kwargs):
-        self.close()
-        self._lock.release()
+        try:
+            self.close()
+        finally:
+            self._lock.release()
 
     def __len__(self):
         p0 = self.tell()
-        self.seek(0, mode=2)
+        self.seek(0, 2)
         p2 = self.tell()
         self.seek(p0)
         return p2
 
     def close(self, *args, **kwargs):
         if 'w' in self._open_mode or 'a' in self._open_mode:
+            if self._mailfile is None:
+                return  # Already handed over to Mailfile
             self.metadata['ts'] = int(time.time())
             self._mailfile._set_file(self)
             self._mailfile = None  # Break reference cycle
         else:
-            StringIO.close(self, *args, **kwargs)
+            io.BytesIO.close(self, *args, **kwargs)
 
 
 class Mailfile_Config(object):
@@ -144,6 +413,7 @@ class Mailfile_Config(object):
 
        <config>.buffering         Boolean: whether or not to buffer changes
        <config>.buffer_max_bytes  Force a flush if we buffer more than this
+       <config>.cache_max_bytes   How much recently read file data to cache
 
        <config>.key               Current encryption key
        <config>.fernet            Current encryption engine
@@ -157,7 +427,7 @@ class Mailfile_Config(object):
         return cls(
             obj.buffering_max_bytes, obj.buffering,
             obj.subject, obj.email_to, obj.email_from,
-            obj.encrypt, obj.fernet, obj.key)
+            obj.encrypt, obj.fernet, obj.key, obj.cache_max_bytes)
 
     def __init__(self,
             buffering_max_bytes=102400,
@@ -167,7 +437,8 @@ class Mailfile_Config(object):
             email_from='.. <from@mailfile.example>',
             encrypt=False,
             fernet=None,
-            key=None):
+            key=None,
+            cache_max_bytes=1024000):
         self.buffering_max_bytes = buffering_max_bytes
         self.buffering = buffering
         self.subject = subject
@@ -176,21 +447,62 @@ class Mailfile_Config(object):
         self.encrypt = encrypt
         self.fernet = fernet
         self.key = key
+        self.cache_max_bytes = cache_max_bytes
 
 
 class Mailfile(object):
     _SNAPSHOT_FILE_PATH = 'Mailfile/metadata'
+    _SNAPSHOT_BATCH = 1000
+    _FETCH_BATCH = 500
+    _METADATA_CACHE_SIZE = 10000
+    _POOL_THREADS = 4
 
-    def __init__(self, imap_obj, base_folder='FILE_STORAGE', **kwargs):
+    def __init__(self, imap_obj, base_folder='FILE_STORAGE',
+                 imap_factory=None, **kwargs):
+        """
+        If an imap_factory is provided, it should be a function returning
+        new, logged-in IMAP connections. Mailfile will then use a few extra
+        connections to upload or download multiple files in parallel, and
+        so threads reading files need not wait for each other.
+        """
         self.config = Mailfile_Config(**kwargs)
         self.imap = imap_obj
+        self._imap_factory = imap_factory
+        self._imap_pool = []
+        self._imap_borrowed = 0
+        self._imap_selected = set()
         self._base_folder = base_folder
-        self._lock = threading.RLock()
+        # Operations which only read our in-memory index (listdir, read
+        # cache hits) share the reader side of this lock, everything else
+        # uses the writer side.
+        self._rwlock = _RWLock()
+        self._lock = self._rwlock.writer
+        self._path_locks = weakref.WeakValueDictionary()
+        self._path_locks_lock = threading.Lock()
         self._sstack = []
         self._unwritten = {}
+        self._unwritten_sizes = {}
+        self._unwritten_encoded = {}
         self._unwritten_bytes = 0
+        self._pending_delete = set()
         self._tree = {}
         self._seen = set([])
+        self._compression_checked = False
+        self._dir_index = None
+        self._tree_paths = None
+        self._unsnapshotted = 0
+        self._uid = os.getuid()
+        self._gid = os.getgid()
+        self._template_key = self._template = None
+        self._metadata_cache = collections.OrderedDict()
+        self._metadata_cache_key = None
+        self._known_uids = None
+        self._known_sorted = None
+        self._read_cache = collections.OrderedDict()
+        self._read_cache_bytes = 0
+        self._read_cache_key = None
+        # Readers share the LRU bookkeeping of the read cache, see _get_file
+        self._read_cache_lock = threading.Lock()
 
     def __enter__(self, *args, **kwargs):
         """
@@ -201,6 +513,11 @@ class Mailfile(object):
         Note that changes to `<instance>.config` made within a `with` block
         are reverted when the block is exited; this allows an application to
         turn encryption on or off temporarily.
+
+        One exception: a `with <instance>.open(...)` block inside this one,
+        on a file which another thread is also writing using `with`, gives
+        up the lock while it waits for that thread to finish. Otherwise the
+        two threads could deadlock.
         """
         self._lock.acquire()
         self._sstack.append(Mailfile_Config._Copy(self.config))
@@ -213,7 +530,8 @@ class Mailfile(object):
         self.config = self._sstack.pop(-1)
         self._lock.release()
 
-    def synchronize(self, cleanup=False, snapshot=None, ignore_snapshot=False):
+    def synchronize(self,
+            cleanup=False, snapshot=None, ignore_snapshot=False, force=False):
         """
         This method implements the Mailfile synchronization protocol, bringing
         our in-memory metadata index up to date with what is on the server.
@@ -225,49 +543,47 @@ class Mailfile(object):
         in an IMAP folder receiving ascending, never-repeated integer IDs.
 
         1. Messages in Mailfile are read and parsed in reverse order:
-           1. If we cannot parse or decrypt the message, ignore it.
+           1. If we cannot fetch, parse or decrypt the message, ignore it.
            2. If we have seen and processed this message before, stop.
            3. File objects: If a message represents a new file or a NEWER
               version of one we've already seen, update our file index.
               If a file object is a snapshot, load and parse it.
            4. All other messages are ignored.
+
+        Message headers are fetched from the server in batches, but a batch
+        never extends past a message we have already seen.
+
+        Unless cleanup or force are requested, we only ask the server for
+        UIDs newer than those we already know about, and fall back to a full
+        search if the message count reveals that something was deleted.
         """
         with self._lock:
+            if not self._compression_checked:
+                self._enable_compression()
             self.flush()
-            if 'OK' != self.imap.select(self._base_folder)[0]:
-                if ('OK' != self.imap.create(self._base_folder)[0] or
-                        'OK' != self.imap.select(self._base_folder)[0]):
-                    raise IOError('Could not select: %s' % self._base_folder)
-
-            (rv, (seqs,)) = self.imap.uid('SEARCH', 'ALL')
+            (rv, count) = self.imap.select(self._base_folder)
             if rv != 'OK':
-                raise IOError(
-                    'Could not search: %s (%s, [%s])'
-                    % (self._base_folder, rv, seqs))
+                if 'OK' == self.imap.create(self._base_folder)[0]:
+                    (rv, count) = self.imap.select(self._base_folder)
+                if rv != 'OK':
+                    raise IOError('Could not select: %s' % self._base_folder)
 
             distance = 0
-            seqs = sorted([int(i) for i in seqs.split(' ') if i])
-            existing = set(seqs)
+            existing, seqs, searched_all = self._search_uids(
+                count, full=(cleanup or force))
             broken = set([])
             to_delete = set([])
-            for seq in reversed(seqs):
+            for seq, metadata in self._fetch_metadata(reversed(seqs)):
                 if seq in self._seen:
                     break
-                try:
-                    (rv, data) = self.imap.uid(
-                        'FETCH', str(seq), '(BODY.PEEK[]<0.1024>)')
-                    if rv != 'OK':
-                        broken.add(seq)
-                        continue
-                    metadata = self._parse_message(
-                        None, data[0][1], headersonly=True, clean=False)
-                    file_path = metadata['fn']
-                    self._seen.add(seq)
-                    distance += 1
-                except (ValueError, NameError, AttributeError, KeyError,
-                        IndexError, InvalidToken):
+                if metadata is None:
                     broken.add(seq)
                     continue
+                file_path = metadata['fn']
+                self._seen.add(seq)
+                distance += 1
+                if file_path != self._SNAPSHOT_FILE_PATH:
+                    self._unsnapshotted += 1
 
                 if self._tree.get(file_path, (-1,))[0] < seq:
                     _clean_metadata(metadata)
@@ -288,7 +604,10 @@ class Mailfile(object):
                     seq, metadata, versions = self._tree[fp]
                     wanted = metadata.get('versions', 1)
                     versions.add(seq)
-                    keeping_versions = existing & set(sorted(versions)[-wanted:])
+                    # Note: asking for 0 versions has always meant keep all
+                    keeping_versions = existing.intersection(
+                        heapq.nlargest(wanted, versions) if (wanted > 0)
+                        else versions)
                     keeping |= keeping_versions
                     if keeping_versions:
                         self._tree[fp] = (
@@ -298,61 +617,242 @@ class Mailfile(object):
 
                 to_delete = sorted(list(self._seen - keeping))
                 if to_delete:
-                    (rs, data) = self.imap.uid('STORE',
-                        ','.join([str(s) for s in to_delete]),
-                        '+FLAGS.SILENT',
-                        '(\Deleted)')
-                    (re, data) = self.imap.expunge()
+                    (rs, re, data) = self._delete_uids(to_delete)
                     if rs == re == 'OK':
                         self._seen -= set(to_delete)
 
-            self._seen &= existing
-            if (snapshot is not False) and (distance > 20 or snapshot is True):
+            # We only add UIDs from `existing` to _seen, so unless a full
+            # search found that messages went away, this would be a no-op.
+            seen_count = len(self._seen)
+            if searched_all:
+                self._seen &= existing
+            if distance or cleanup or len(self._seen) != seen_count:
+                self._dir_index = self._tree_paths = None
+            # A snapshot only needs to cover messages older than itself, and
+            # deletions are filtered out when it is loaded, so if nothing but
+            # snapshots arrived since we last saved one, that one will do.
+            if ((snapshot is not False) and self._unsnapshotted and
+                    (distance > 20 or snapshot is True)):
                 self.save_snapshot()
 
+    def _search_uids(self, count, full=False):
+        """
+        Return the set of UIDs in the selected folder, the same UIDs as a
+        sorted list, and whether we did a full search. The count is the data
+        returned by SELECT, the number of messages in the folder.
+
+        Note: the returned set and list are kept for next time, so callers
+        must not modify them.
+        """
+        known = self._known_uids
+        try:
+            count = int(count[0])
+        except (TypeError, ValueError, IndexError):
+            count = None
+        if known is not None and count is not None and not full:
+            if self._known_sorted is None:
+                self._known_sorted = sorted(known)
+            first = (self._known_sorted[-1] + 1) if known else 1
+            (rv, (seqs,)) = self.imap.uid('SEARCH', 'UID', '%d:*' % first)
+            if rv == 'OK':
+                # Note: n:* always matches the newest message, even if its
+                # UID is lower than n.
+                new = sorted(set(
+                    i for i in (int(i) for i in seqs.split()) if i >= first))
+                if len(known) + len(new) == count:
+                    known.update(new)
+                    self._known_sorted.extend(new)
+                    return known, self._known_sorted, False
+
+        (rv, (seqs,)) = self.imap.uid('SEARCH', 'ALL')
+        if rv != 'OK':
+            raise IOError(
+                'Could not search: %s (%s, [%s])'
+                % (self._base_folder, rv, seqs))
+        self._known_uids = set(int(i) for i in seqs.split(' ') if i)
+        self._known_sorted = sorted(self._known_uids)
+        return self._known_uids, self._known_sorted, True
+
+    def _delete_uids(self, uids):
+        """
+        Flag the given (sorted) UIDs as deleted and expunge them, returning
+        the STORE and EXPUNGE result codes and the last response data. If
+        the server supports UIDPLUS, only our messages get expunged.
+        """
+        uid_set = _compress_uid_set(uids)
+        (rs, data) = self.imap.uid(
+            'STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if rs != 'OK':
+            return (rs, None, data)
+        if 'UIDPLUS' in getattr(self.imap, 'capabilities', ()):
+            (re, data) = self.imap.uid('EXPUNGE', uid_set)
+        else:
+            (re, data) = self.imap.expunge()
+        if re == 'OK' and self._known_uids is not None:
+            self._known_uids -= set(uids)
+            self._known_sorted = None
+        return (rs, re, data)
+
+    def _enable_compression(self):
+        """
+        Ask the IMAP server to DEFLATE all traffic (RFC 4978), if both the
+        server and our IMAP object support it. This has to happen after
+        login, so we try once, on the first synchronize.
+        """
+        self._compression_checked = True
+        imap = self.imap
+        if (getattr(imap, 'state', None) not in ('AUTH', 'SELECTED')
+                or getattr(imap, '_mailfile_deflate', False)
+                or not hasattr(imap, '_simple_command')):
+            return False
+        try:
+            rv, caps = imap.capability()
+            if rv != 'OK' or 'COMPRESS=DEFLATE' not in caps[0].split():
+                return False
+            imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+            if imap._simple_command('COMPRESS', 'DEFLATE')[0] != 'OK':
+                return False
+        except imap.error:
+            return False
+        stream = _DeflateStream(getattr(imap, 'sslobj', None) or imap.sock)
+        imap.read = stream.read
+        imap.readline = stream.readline
+        imap.send = stream.send
+        imap._mailfile_deflate = True
+        return True
+
+    def _fetch_metadata(self, seqs):
+        """
+        Fetch and parse message metadata for the given UIDs, yielding
+        (seq, metadata) pairs in order; metadata is None if the message
+        could not be fetched or parsed. Requests are batched to save
+        round-trips, stopping at the first UID that is already in
+        self._seen when the batch is built. Parse results are cached
+        by UID, so messages we cannot read are not fetched over and over.
+        """
+        cache = self._metadata_cache
+        if self._metadata_cache_key != self.config.key:
+            cache.clear()
+            self._metadata_cache_key = self.config.key
+
+        batch = []
+        for seq in seqs:
+            if seq in self._seen:
+                break
+            if seq in cache:
+                for result in self._parse_batch(batch):
+                    yield result
+                batch = []
+                metadata = cache.pop(seq)
+                cache[seq] = metadata
+                yield (seq, dict(metadata) if metadata else None)
+                continue
+            batch.append(seq)
+            if len(batch) >= self._FETCH_BATCH:
+                for result in self._parse_batch(batch):
+                    yield result
+                batch = []
+        for result in self._parse_batch(batch):
+            yield result
+
+    def _parse_batch(self, batch):
+        # Bind these once, this loop runs for every message in the folder.
+        cache = self._metadata_cache
+        cache_size = self._METADATA_CACHE_SIZE
+        parse_header = self._parse_header
+        for seq, data in self._fetch_batch(batch):
+            if data is None:
+                yield (seq, None)
+                continue
+            try:
+                metadata = parse_header(data)
+                if 'fn' not in metadata:
+                    raise KeyError('fn')
+            except (ValueError, NameError, AttributeError, KeyError,
+                    IndexError, TypeError, InvalidToken):
+                metadata = None
+            cache[seq] = metadata
+            while len(cache) > cache_size:
+                cache.popitem(last=False)
+            yield (seq, dict(metadata) if metadata else None)
+
+    def _fetch_batch(self, batch):
+        if not batch:
+            return []
+        fetched = {}
+        (rv, data) = self.imap.uid(
+            'FETCH', _compress_uid_set(sorted(batch)),
+            '(BODY.PEEK[HEADER.FIELDS (X-Mailfile)])')
+        if rv == 'OK':
+            for part in data:
+                if not isinstance(part, tuple):
+                    continue
+                uid = _FETCH_UID_RE.search(part[0])
+                if uid:
+                    fetched[int(uid.group(1))] = part[1]
+                elif len(batch) == 1:
+                    fetched[batch[0]] = part[1]
+        return [(seq, fetched.get(seq)) for seq in batch]
+
     def save_snapshot(self):
         """
         Save a snapshot of the current metadata index back to IMAP.
         """
-        def _j(smv):
-            seq, metadata, versions = smv
-            return [seq, metadata, list(versions)]
-        with self.open(self._SNAPSHOT_FILE_PATH, 'w') as fd:
-            fd.write(zlib.compress(json.dumps({
-                'tree': dict((fp, _j(self._tree[fp])) for fp in self._tree),
-                'seen': list(self._seen)})))
+        # The tree is serialized a slice at a time and compressed as we go,
+        # so neither the full JSON nor a second copy of the compressed
+        # snapshot is ever held in RAM. The (seq, metadata, versions) tuples
+        # serialize as JSON lists and the sets get converted on the fly.
+        # No `with` here: waiting for the file's path lock could make us
+        # give up our own lock halfway (see _RWLock.acquire_other).
+        compressor = zlib.compressobj()
+        fd = self.open(self._SNAPSHOT_FILE_PATH, 'w')
+        fd.write(compressor.compress('{"seen":%s,"tree":{' % _json_dumps(
+            self._seen, default=list)))
+        items = iter(self._tree.items())
+        sep = ''
+        while True:
+            batch = dict(itertools.islice(items, self._SNAPSHOT_BATCH))
+            if not batch:
+                break
+            fd.write(compressor.compress(
+                sep + _json_dumps(batch, default=list)[1:-1]))
+            sep = ','
+        fd.write(compressor.compress('}}'))
+        fd.write(compressor.flush())
+        fd.close()
+        self._unsnapshotted = 0
 
     def _parse_snapshot(self, seq, existing):
-        metadata, contents = self._get_file(self._SNAPSHOT_FILE_PATH, seq)
-        snapshot = json.loads(zlib.decompress(contents))
-        for file_path in snapshot['tree']:
-            seq, metadata, versions = snapshot['tree'][file_path]
+        # The connection we are synchronizing over just told us about this
+        # message, so fetch it there; a spare connection from the pool may
+        # not have seen it yet. Snapshots are read once, skip the cache.
+        (rv, data) = self.imap.uid('FETCH', str(seq), '(BODY.PEEK[])')
+        if rv != 'OK' or not isinstance(data[0], tuple):
+            raise OSError('Could not fetch snapshot: %s (%s)' % (seq, data[0]))
+        metadata, contents = self._parse_message(
+            self._SNAPSHOT_FILE_PATH, data[0][1])
+        del data
+        contents = zlib.decompress(contents)  # Release the compressed data
+        snapshot = _json_loads(contents)
+        del contents
+        tree = self._tree
+        for file_path, (seq, metadata, versions) in snapshot['tree'].items():
             if seq not in existing:
                 continue
-            versions = set(versions) & existing
-            if file_path in self._tree:
-                versions.update(self._tree[file_path][2] & existing)
-                self._tree[file_path][2].update(versions)
-            if file_path not in self._tree or seq > self._tree[file_path][0]:
-                self._tree[file_path] = (seq, metadata, versions)
-        self._seen |= (set(snapshot['seen']) & existing)
-
-    def _maybe_encrypt(self, data, b64encode=False):
-        if self.config.encrypt:
-            return '!' + self.config.fernet.encrypt(data)
-        if b64encode:
-            return base64.b64encode(data)
-        return data
+            current = tree.get(file_path)
+            if current is None:
+                tree[file_path] = (
+                    seq, metadata, existing.intersection(versions))
+            else:
+                current[2].update(existing.intersection(versions))
+                if seq > current[0]:
+                    tree[file_path] = (seq, metadata, current[2] & existing)
+        self._seen.update(existing.intersection(snapshot['seen']))
 
-    def _reflow(self, data, indent='', linelen=78, preserve=False):
-        if preserve:
-            return indent + data.replace('\n', '\r\n' + indent).strip()
-        else:
-            linelen -= len(indent)
-            return indent + re.sub(
-                '(\S{%d,%d})' % (linelen, linelen),
-                lambda m: m.group(0)+'\r\n'+indent,
-                ''.join(data.split())).strip()
+    def _encrypt(self, data, suffix=b''):
+        if len(data) > _LARGE_BODY_BYTES:
+            return _fernet_encrypt(self.config.key, data, suffix)
+        return self.config.fernet.encrypt(data + suffix)
 
     def encode_object(self, file_path, file_data, metadata=None):
         """
@@ -386,38 +886,59 @@ class Mailfile(object):
         if metadata:
             mdata.update(metadata)
         mdata.update({'fn': file_path, 'bytes': len(file_data)})
-        xmailfile = json.dumps(mdata, indent=1).strip()
+        xmailfile = _json_dumps(mdata)
 
         if self.config.encrypt:
             # Note: The padding numbers, 148 and 2048, are chosen in part to
             #       keep small files below 3*1500 bytes: three network packets
             #       assuming a common network MTU, and <one 4KB block on disk.
-            encoding = '7bit'
-            subject = self.config.subject
-            filename = 'mailfile.enc'
-            padding = ('_' * 200)
-            mdata['_'] = padding[:148 - (len(xmailfile) % 148)]
-            xmailfile = json.dumps(mdata, indent=1)
-            file_data += (' ' * (2048 - (len(file_data) % 2048)))
-        else:
-            encoding = 'base64'
-            subject = '%s: %s' % (self.config.subject, file_path)
-            filename = os.path.basename(file_path)
-
-        return '\r\n'.join([
-            'To: %s' % self.config.email_to,
-            'From: %s' % self.config.email_from,
-            'Subject: %s' % subject,
-            'X-Keep-On-Server: manual-delete, not-email',
-            'X-Mailfile:',
-            self._reflow(
-                self._maybe_encrypt(xmailfile, b64encode=True),
-                indent=' ', preserve=(not self.config.encrypt)),
-            'Content-Type: application/x-mailfile',
-            'Content-Transfer-Encoding: %s' % encoding,
-            'Content-Disposition: attachment; filename="%s"' % filename,
-            '',
-            self._reflow(self._maybe_encrypt(file_data, b64encode=True))])
+            mdata['_'] = _METADATA_PADDING[:148 - (len(xmailfile) % 148)]
+            xmailfile = _json_dumps(mdata)
+            # Passed separately, to avoid copying the data just to pad it
+            suffix = _DATA_PADDING[:2048 - (len(file_data) % 2048)]
+            # Encrypted data is marked with a '!', see _decode_payload
+            header = _wrap(self._encrypt(xmailfile), 77, ' ', '!')
+            body = _wrap(self._encrypt(file_data, suffix), prefix='!')
+            # Subject and filename are the same for every encrypted message
+            # and already part of the template.
+            return self._message_template() % (header, body)
+
+        return self._message_template() % (
+            '%s: %s' % (self.config.subject, file_path),
+            _wrap(base64.b64encode(xmailfile), 77, ' '),
+            os.path.basename(file_path),
+            _wrap(base64.b64encode(file_data)))
+
+    def _message_template(self):
+        """
+        Return a %-template for encoded messages, with everything that does
+        not vary from one message to the next already filled in. The
+        template expects the subject, X-Mailfile header, filename and file
+        data; only the header and data when we are encrypting.
+        """
+        config = self.config
+        key = (config.email_to, config.email_from, config.subject,
+               config.encrypt)
+        if self._template_key != key:
+            if config.encrypt:
+                subject = config.subject.replace('%', '%%')
+                encoding, filename = '7bit', 'mailfile.enc'
+            else:
+                subject, encoding, filename = '%s', 'base64', '%s'
+            self._template = '\r\n'.join([
+                'To: %s' % key[0].replace('%', '%%'),
+                'From: %s' % key[1].replace('%', '%%'),
+                'Subject: %s' % subject,
+                'X-Keep-On-Server: manual-delete, not-email',
+                'X-Mailfile:',
+                '%s',
+                'Content-Type: application/x-mailfile',
+                'Content-Transfer-Encoding: %s' % encoding,
+                'Content-Disposition: attachment; filename="%s"' % filename,
+                '',
+                '%s'])
+            self._template_key = key
+        return self._template
 
     def set_encryption_key(self, key):
         """
@@ -427,55 +948,238 @@ class Mailfile(object):
         Note: The key is NOT stretched for you, it is just hashed to a standard
         size before use. Please use `cryptography.fernet.Fernet.generate_key`
         or something of equivalent strength to generate strong keys.
+
+        The resulting Fernet object is shared by all operations (and threads)
+        until the key is changed again; there is no need to call this more
+        than once per key.
         """
-        self.config.key = urlsafe_b64encode(hashlib.sha256(key).digest()[:32])
-        self.config.fernet = Fernet(self.config.key)
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        self.config.key = urlsafe_b64encode(hashlib.sha256(key).digest())
+        self.config.fernet = _make_fernet(self.config.key)
         self.config.encrypt = True
 
     def flush(self):
         """
-        Write any buffered changes to the remote server. This gets called
-        automatically when exiting a `with mailfile ...` block. Returns True
-        upon success, False if there was a problem writing to the server.
+        Write any buffered changes (including deletions) to the remote
+        server. This gets called automatically when exiting a `with
+        mailfile ...` block. Returns True upon success, False if there was
+        a problem writing to the server.
         """
         happy = True
         with self._lock:
-            for file_path in self._unwritten.keys():
-                fobj = self._unwritten[file_path]
-                eml = self.encode_object(
-                    file_path, fobj.getvalue(), metadata=fobj.metadata)
-                (rv, d) = self.imap.append(self._base_folder, None, None, eml)
+            if self._imap_factory and len(self._unwritten) > 1:
+                results = self._parallel_append(list(self._unwritten.items()))
+            else:
+                results = self._pipelined_append(list(self._unwritten.items()))
+            for file_path, rv in results:
                 if rv == 'OK':
-                    self._unwritten_bytes -= len(self._unwritten[file_path])
-                    del self._unwritten[file_path]
+                    self._drop_unwritten(file_path)
+                else:
+                    happy = False
+            pending = self._pending_delete
+            if pending:
+                (rs, re, data) = self._delete_uids(sorted(pending))
+                if rs == 'OK':
+                    self._seen -= pending
+                    self._pending_delete = set()
                 else:
                     happy = False
         return happy
 
+    def _encode_unwritten(self, file_path, fobj):
+        # The encoded message is kept until the upload succeeds (flush then
+        # calls _drop_unwritten), so retries need not encrypt it again.
+        cached = self._unwritten_encoded.get(file_path)
+        settings = self._encoding_settings()
+        if cached and cached[0] is fobj and cached[1] == settings:
+            return cached[2]
+        eml = self.encode_object(
+            file_path, fobj.getvalue(), metadata=fobj.metadata)
+        self._unwritten_encoded[file_path] = (fobj, settings, eml)
+        return eml
+
+    def _encoding_settings(self):
+        # Everything in our config which changes what encode_object makes.
+        config = self.config
+        return (config.email_to, config.email_from, config.subject,
+                config.encrypt, config.key)
+
+    def _append(self, imap, file_path, fobj):
+        eml = self._encode_unwritten(file_path, fobj)
+        return imap.append(self._base_folder, None, None, eml)[0]
+
+    def _pipelined_append(self, items):
+        """
+        Upload files one by one over our main connection, while a helper
+        thread encodes (and encrypts) the files ahead of us. The queue in
+        between holds a single message, so the helper never gets more than
+        one file ahead. Errors from the helper are raised here.
+        """
+        if len(items) < 2:
+            for file_path, fobj in items:
+                yield (file_path, self._append(self.imap, file_path, fobj))
+            return
+
+        encoded = queue.Queue(maxsize=1)
+        stopped = []
+
+        def encoder():
+            for file_path, fobj in items:
+                try:
+                    result = (self._encode_unwritten(file_path, fobj), None)
+                except Exception as e:
+                    result = (None, e)
+                encoded.put(result)
+                if stopped:
+                    return
+
+        helper = threading.Thread(target=encoder)
+        helper.daemon = True
+        helper.start()
+        try:
+            for file_path, fobj in items:
+                eml, error = encoded.get()
+                if error is not None:
+                    raise error
+                rv = self.imap.append(self._base_folder, None, None, eml)[0]
+                yield (file_path, rv)
+        finally:
+            # If we stopped early, unblock the helper so it can exit.
+            stopped.append(True)
+            while helper.is_alive():
+                try:
+                    encoded.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            helper.join()
+
+    def _parallel_append(self, items):
+        """
+        Upload files using a small pool of extra IMAP connections, one
+        thread per connection. Anything the pool fails to handle (e.g.
+        because a connection broke) is retried on our main connection,
+        where any remaining errors are raised to our caller.
+        """
+        self._grow_pool(len(items))
+        jobs = queue.Queue()
+        for item in items:
+            jobs.put(item)
+        results = []
+        broken = []
+        retry = []
+
+        def worker(imap):
+            while True:
+                try:
+                    file_path, fobj = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results.append(
+                        (file_path, self._append(imap, file_path, fobj)))
+                except (imaplib.IMAP4.error, socket.error, IOError, OSError):
+                    broken.append(imap)
+                    jobs.put((file_path, fobj))
+                    return
+                except Exception:
+                    # Not the connection's fault; leave it for the main
+                    # thread, so the error is not lost with this thread.
+                    retry.append((file_path, fobj))
+
+        self._run_pool(worker, broken)
+        for result in results:
+            yield result
+        while not jobs.empty():
+            retry.append(jobs.get_nowait())
+        for file_path, fobj in retry:
+            yield (file_path, self._append(self.imap, file_path, fobj))
+
     def _maybe_flush(self):
         if (not self.config.buffering
                 or self.config.buffering_max_bytes < self._unwritten_bytes):
             self.flush()
 
+    def _drop_unwritten(self, file_path):
+        self._unwritten_encoded.pop(file_path, None)
+        if file_path in self._unwritten:
+            del self._unwritten[file_path]
+            self._unwritten_bytes -= self._unwritten_sizes.pop(file_path)
+
+    def _path_lock(self, file_path):
+        """
+        Return the lock used by Mailfile_File objects for a given path. It
+        serializes `with` blocks writing the same file, without blocking
+        others. Locks are forgotten once no file object refers to them.
+
+        Lock ordering: path locks are held while user code runs, and that
+        code may well need self._lock. So a thread may wait for self._lock
+        while holding a path lock, but never the other way around; see
+        _RWLock.acquire_other.
+        """
+        with self._path_locks_lock:
+            lock = self._path_locks.get(file_path)
+            if lock is None:
+                lock = self._path_locks[file_path] = threading.RLock()
+            return lock
+
     def _set_file(self, file_obj):
+        encoded = None
+        if not self.config.buffering:
+            # We are about to upload this, so do the expensive encoding (and
+            # encryption) before taking the lock; this lets writers of
+            # different files use more than one CPU core.
+            settings = self._encoding_settings()
+            encoded = (file_obj, settings, self.encode_object(
+                file_obj.file_path, file_obj.getvalue(),
+                metadata=file_obj.metadata))
         with self._lock:
+            # Record the size at hand-off, so replacing a buffered file (or
+            # writing to a file object after close) cannot skew our total.
+            size = len(file_obj)
+            self._drop_unwritten(file_obj.file_path)
             self._unwritten[file_obj.file_path] = file_obj
-            self._unwritten_bytes += len(file_obj)
+            self._unwritten_sizes[file_obj.file_path] = size
+            self._unwritten_bytes += size
+            if encoded is not None:
+                self._unwritten_encoded[file_obj.file_path] = encoded
             self._maybe_flush()
 
-    def _parse_message(self, file_path, data, headersonly=False, clean=True):
-        if headersonly:
-            parser = email.parser.HeaderParser()
+    def _decode_payload(self, data):
+        if data[:1] == '!':
+            return self.config.fernet.decrypt(
+                data[1:].translate(None, _WHITESPACE))
+        return base64.b64decode(data)
+
+    def _parse_header(self, data, legacy=False):
+        """
+        Extract and decode the X-Mailfile metadata from the start of one of
+        our messages, without running it through the email parser (unless
+        our quick regex fails, or legacy=True is requested).
+        """
+        split = _HEADER_END_RE.search(data)
+        end = split.start() if (split is not None) else len(data)
+        match = None if legacy else _X_MAILFILE_RE.search(data, 0, end)
+        if match is not None:
+            header = match.group(1)
         else:
-            parser = email.parser.Parser()
-        message = parser.parsestr(data, headersonly=headersonly)
+            header = _HEADER_PARSER.parsestr(data[:end])['X-Mailfile']
+            if header is None:
+                raise ValueError('No X-Mailfile header found')
+        return _json_loads(self._decode_payload(header.strip()))
 
-        xmailfile = message['X-Mailfile'].strip()
-        if xmailfile[:1] == '!':
-            xmailfile = self.config.fernet.decrypt(xmailfile[1:])
+    def _parse_message(self, file_path, data, headersonly=False, clean=True):
+        # We only need the email parser for the headers; our own messages
+        # are not multipart, so the body follows the first blank line. The
+        # full MIME parse is only needed if something rewrapped the message.
+        split = _HEADER_END_RE.search(data)
+        if split is not None:
+            message = _HEADER_PARSER.parsestr(data[:split.start()])
         else:
-            xmailfile = base64.b64decode(xmailfile)
-        metadata = json.loads(xmailfile)
+            message = _HEADER_PARSER.parsestr(data)
+
+        metadata = _json_loads(
+            self._decode_payload(message['X-Mailfile'].strip()))
 
         if file_path and metadata['fn'] != file_path:
             raise IOError('File path mismatch: %s' % metadata['fn'])
@@ -486,50 +1190,295 @@ class Mailfile(object):
         if headersonly:
             return metadata
 
-        for part in message.walk():
-            if part.get_content_type() == 'application/x-mailfile':
-                contents = part.get_payload()
-                if contents[:1] == '!':
-                    contents = self.config.fernet.decrypt(contents[1:])
-                else:
-                    contents = base64.b64decode(contents)
-                return metadata, contents[:metadata['bytes']]
+        if (split is not None and
+                message.get_content_type() == 'application/x-mailfile'):
+            parts = [data[split.end():]]
+        else:
+            parts = [part.get_payload()
+                     for part in _FULL_PARSER.parsestr(data).walk()
+                     if part.get_content_type() == 'application/x-mailfile']
+        for payload in parts:
+            contents = self._decode_payload(payload)
+            return metadata, contents[:metadata['bytes']]
 
         raise OSError(
             'No data in message, %s is corrupt?' % (file_path or 'file'))
 
     def _get_file(self, file_path, version):
+        # Cache hits only need the reader side of our lock, so threads
+        # reading popular files do not wait for each other.
+        with self._rwlock.reader:
+            seq = self._file_seq(file_path, version)
+            with self._read_cache_lock:
+                cached = self._read_cached(seq)
+        if cached is not None:
+            return cached
+        with self._lock:
+            seq = self._file_seq(file_path, version)
+            cached = self._read_cached(seq)
+            if cached is not None:
+                return cached
+            imap = self._borrow_imap()
+            if imap is None:
+                return self._fetch_file(self.imap, file_path, seq)
+        try:
+            return self._fetch_file(imap, file_path, seq)
+        except (imaplib.IMAP4.error, socket.error):
+            self._imap_selected.discard(imap)
+            imap = None
+        except (OSError, IOError):
+            # The spare connection may lag behind ours; try again below.
+            pass
+        finally:
+            self._return_imap(imap)
         with self._lock:
-            seq, metadata, versions = self._tree[file_path]
-            if version is not None:
-                if version not in versions:
-                    raise KeyError('Unknown version: %s' % version)
-                seq = version
+            return self._fetch_file(self.imap, file_path, seq)
 
-            (rv, data) = self.imap.uid('FETCH', str(seq), '(BODY[])')
-            if rv != 'OK':
-                raise OSError(
-                    'Could not fetch: %s=%s (%s)' % (file_path, seq, data[0]))
+    def _fetch_file(self, imap, file_path, seq):
+        (rv, data) = imap.uid('FETCH', str(seq), '(BODY[])')
+        if rv != 'OK' or not isinstance(data[0], tuple):
+            raise OSError(
+                'Could not fetch: %s=%s (%s)' % (file_path, seq, data[0]))
 
-            return self._parse_message(file_path, data[0][1])
+        metadata, contents = self._parse_message(file_path, data[0][1])
+        with self._lock:
+            self._cache_read(seq, metadata, contents)
+        return metadata, contents
+
+    def _borrow_imap(self):
+        """
+        Take a connection from our pool (opening one if there is room),
+        for use without holding our lock. Returns None if we have no
+        imap_factory or no spare connections. Call with the lock held,
+        and hand the connection back using _return_imap.
+        """
+        if not self._imap_factory:
+            return None
+        if self._imap_pool:
+            imap = self._imap_pool.pop()
+        elif self._imap_borrowed < self._POOL_THREADS:
+            try:
+                imap = self._imap_factory()
+            except (imaplib.IMAP4.error, socket.error, IOError, OSError):
+                return None
+        else:
+            return None
+        if imap not in self._imap_selected:
+            try:
+                if imap.select(self._base_folder)[0] != 'OK':
+                    raise IOError('Select failed')
+                self._imap_selected.add(imap)
+            except (imaplib.IMAP4.error, socket.error, IOError, OSError):
+                return None
+        self._imap_borrowed += 1
+        return imap
+
+    def _return_imap(self, imap):
+        """Return a borrowed connection; pass None if it broke."""
+        with self._lock:
+            self._imap_borrowed -= 1
+            if imap is not None:
+                self._imap_pool.append(imap)
+
+    def _file_seq(self, file_path, version):
+        seq, metadata, versions = self._tree[file_path]
+        if version is not None:
+            if version not in versions:
+                raise KeyError('Unknown version: %s' % version)
+            seq = version
+        return seq
+
+    def _read_cached(self, seq):
+        cache = self._read_cache
+        if self._read_cache_key != self.config.key:
+            cache.clear()
+            self._read_cache_bytes = 0
+            self._read_cache_key = self.config.key
+        if seq in cache:
+            metadata, contents = cache.pop(seq)
+            cache[seq] = (metadata, contents)
+            return dict(metadata), contents
+        return None
+
+    def _cache_read(self, seq, metadata, contents):
+        cache = self._read_cache
+        if len(contents) <= self.config.cache_max_bytes:
+            cache[seq] = (dict(metadata), contents)
+            self._read_cache_bytes += len(contents)
+            while self._read_cache_bytes > self.config.cache_max_bytes:
+                evicted = cache.popitem(last=False)[1]
+                self._read_cache_bytes -= len(evicted[1])
+
+    def read_many(self, file_paths, version=None):
+        """
+        Read the contents of multiple files, yielding (file_path, contents)
+        pairs in order. Files are fetched in batches, one round-trip per
+        batch, which is much faster than opening small files one by one.
+        If we have an imap_factory, a few batches are fetched in parallel.
+        Raises OSError, like open(), for files which cannot be read.
+        """
+        file_paths = collections.deque(_clean_path(fp) for fp in file_paths)
+        while file_paths:
+            with self._lock:
+                batches = []
+                threads = self._POOL_THREADS if self._imap_factory else 1
+                while file_paths and len(batches) < threads:
+                    batches.append(self._plan_read(file_paths, version))
+
+                fetched = {}
+                for bodies in self._parallel_fetch([f for b, f in batches]):
+                    fetched.update(bodies)
+
+                results = []
+                for file_path, seq in sum((b for b, f in batches), []):
+                    if seq is None:
+                        results.append((
+                            file_path,
+                            self._unwritten[file_path].getvalue()))
+                        continue
+                    cached = self._read_cached(seq)
+                    if cached is None and seq in fetched:
+                        cached = self._parse_message(file_path, fetched[seq])
+                        self._cache_read(seq, *cached)
+                    elif cached is None:
+                        # Cached when we planned, but evicted since.
+                        cached = self._fetch_file(self.imap, file_path, seq)
+                    if cached[0].get('deleted'):
+                        raise OSError(
+                            'Error open(%s): File is deleted' % file_path)
+                    results.append((file_path, cached[1]))
+            for result in results:
+                yield result
+
+    def _plan_read(self, file_paths, version):
+        """
+        Pop paths off the file_paths deque until we have a batch worth
+        fetching, returning a list of (file_path, seq) and a list of UIDs
+        to fetch.
+        """
+        batch, fetch, size = [], [], 0
+        while file_paths and len(fetch) < self._FETCH_BATCH:
+            if fetch and size > self.config.cache_max_bytes:
+                break
+            file_path = file_paths.popleft()
+            if file_path in self._unwritten:
+                batch.append((file_path, None))
+                continue
+            try:
+                seq = self._file_seq(file_path, version)
+            except KeyError as e:
+                raise OSError('Error open(%s): %s' % (file_path, e))
+            batch.append((file_path, seq))
+            if seq not in self._read_cache:
+                fetch.append(seq)
+                size += self._tree[file_path][1].get('bytes', 0)
+        return batch, fetch
+
+    def _fetch_bodies(self, imap, seqs):
+        fetched = {}
+        if seqs:
+            (rv, data) = imap.uid(
+                'FETCH', _compress_uid_set(sorted(seqs)), '(BODY[])')
+            for part in (data if rv == 'OK' else []):
+                uid = isinstance(part, tuple) and _FETCH_UID_RE.search(part[0])
+                if uid:
+                    fetched[int(uid.group(1))] = part[1]
+        return fetched
+
+    def _parallel_fetch(self, fetches):
+        """
+        Fetch message bodies for each list of UIDs, returning a list of
+        dicts. Like _parallel_append, this uses our pool of extra IMAP
+        connections if there is more than one list; anything the pool
+        fails to fetch is fetched using our main connection.
+        """
+        fetches = [f for f in fetches if f]
+        if (len(fetches) < 2 or not self._imap_factory
+                or not self._grow_pool(len(fetches))):
+            return [self._fetch_bodies(self.imap, f) for f in fetches]
+
+        jobs = queue.Queue()
+        for seqs in fetches:
+            jobs.put(seqs)
+        results = []
+        broken = []
+
+        def worker(imap):
+            try:
+                imap.select(self._base_folder)
+            except (imaplib.IMAP4.error, socket.error, IOError, OSError):
+                broken.append(imap)
+                return
+            while True:
+                try:
+                    seqs = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results.append(self._fetch_bodies(imap, seqs))
+                except (imaplib.IMAP4.error, socket.error, IOError, OSError):
+                    broken.append(imap)
+                    jobs.put(seqs)
+                    return
+
+        self._run_pool(worker, broken)
+        while not jobs.empty():
+            results.append(self._fetch_bodies(self.imap, jobs.get_nowait()))
+        return results
+
+    def _grow_pool(self, wanted):
+        while len(self._imap_pool) < min(wanted, self._POOL_THREADS):
+            try:
+                self._imap_pool.append(self._imap_factory())
+            except (imaplib.IMAP4.error, socket.error, IOError, OSError):
+                break
+        return self._imap_pool
+
+    def _run_pool(self, worker, broken):
+        threads = [threading.Thread(target=worker, args=(imap,))
+                   for imap in self._imap_pool]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        for imap in broken:
+            self._imap_pool.remove(imap)
 
     def listdir(self, file_path):
         """Emulate os.listdir() for a given path."""
-        dirents = []
-        with self._lock:
-            clean_path = _clean_path(file_path)
-            if clean_path:
-                clean_path += '/'
-            potentials = [k for k in self._tree if k.startswith(clean_path)
-                          and not self._tree[k][1].get('deleted')
-                          and self._tree[k][0] in self._seen]
-            if potentials:
-                dirents = ['.', '..']
-            for p in potentials:
-                dirents.append(p[len(clean_path):].split('/')[0])
-        if not dirents:
+        with self._rwlock.reader:
+            dir_index = self._dir_index
+            if dir_index is None:
+                dir_index = self._dir_index = self._build_dir_index()
+            children = dir_index.get(_clean_path(file_path))
+        if not children:
             raise OSError('No such file or directory: `%s`' % file_path)
-        return sorted(list(set(dirents)))
+        return sorted(list(children | set(['.', '..'])))
+
+    def _sorted_tree_paths(self):
+        """
+        Return a sorted list of every path in our tree, including deleted
+        files. The list is cached, callers must not modify it.
+        """
+        with self._rwlock.reader:
+            if self._tree_paths is None:
+                self._tree_paths = sorted(self._tree.keys())
+            return self._tree_paths
+
+    def _build_dir_index(self):
+        """
+        Map each directory to the names of its immediate children, counting
+        only files which exist and are not deleted.
+        """
+        dir_index = {}
+        for file_path, (seq, metadata, versions) in self._tree.items():
+            if metadata.get('deleted') or seq not in self._seen:
+                continue
+            parts = file_path.split('/')
+            for i in range(0, len(parts)):
+                dir_index.setdefault('/'.join(parts[:i]), set()).add(parts[i])
+        return dir_index
 
     def lstat(self, file_path, fh=None):
         """Emulate os.lstat() for a given path."""
@@ -549,22 +1498,24 @@ class Mailfile(object):
             'st_nlink': 1,
             'st_mode': mode,
             'st_size': size,
-            'st_gid': os.getgid(),
-            'st_uid': os.getuid()}
+            'st_gid': self._gid,
+            'st_uid': self._uid}
 
     def remove(self, file_path, versions=None):
         file_path = _clean_path(file_path)
         with self._lock:
-            if file_path in self._unwritten:
-                del self._unwritten[file_path]
+            self._drop_unwritten(file_path)
 
             finfo = self._tree.get(file_path)
             if finfo is None:
                 raise OSError('No such file: %s' % (file_path,))
 
+            # Files are not opened using `with` here, as waiting for their
+            # path locks could make us give up our own lock halfway.
             if finfo[1].get('versions', 1) > 1 and not versions:
-                with self.open(file_path, 'w') as fd:
-                    fd.metadata['deleted'] = True
+                fd = self.open(file_path, 'w')
+                fd.metadata['deleted'] = True
+                fd.close()
                 return self.synchronize(snapshot=True)
 
             if not versions:
@@ -573,51 +1524,64 @@ class Mailfile(object):
                 if version not in finfo[2]:
                     raise OSError('No such version: %s[%s]' % (file_path, version))
 
-            (rs, data) = self.imap.uid('STORE',
-                ','.join([str(s) for s in versions]),
-                '+FLAGS.SILENT',
-                '(\Deleted)')
-            if rs != 'OK':
-                raise OSError('Delete failed: %s' % data[0])
-            (re, data) = self.imap.expunge()
+            if self.config.buffering:
+                # Deleted along with any other removals when we flush
+                self._pending_delete |= set(versions)
+            else:
+                (rs, re, data) = self._delete_uids(sorted(versions))
+                if rs != 'OK':
+                    raise OSError('Delete failed: %s' % data[0])
 
+            self._dir_index = self._tree_paths = None
             for v in versions:
                 finfo[2].remove(v)
             if len(finfo[2]):
+                # Avoid downloading the surviving version just to read its
+                # metadata, if we already have it.
                 seq = max(finfo[2])
-                with self.open(file_path, 'r', version=seq) as fd:
-                    self._tree[file_path] = (
-                        seq, _clean_metadata(fd.metadata), finfo[2])
+                if seq == finfo[0]:
+                    metadata = finfo[1]
+                elif (self._metadata_cache.get(seq) and
+                        self._metadata_cache_key == self.config.key):
+                    metadata = _clean_metadata(
+                        dict(self._metadata_cache[seq]))
+                else:
+                    fd = self.open(file_path, 'r', version=seq)
+                    metadata = _clean_metadata(fd.metadata)
+                self._tree[file_path] = (seq, metadata, finfo[2])
             else:
                 del self._tree[file_path]
 
-            self.synchronize(cleanup=True, snapshot=True)
+            if not self.config.buffering:
+                self.synchronize(cleanup=True, snapshot=True)
 
     def open(self, file_path, mode='r', version=None):
         """Open an Mailfile file for reading, writing or appending."""
-        with self._lock:
-            file_path = _clean_path(file_path)
-            contents = ''
-            metadata = {}
-            mode = mode.replace('+', 'w')
-            if file_path in self._unwritten:
-                file_obj = self._unwritten[file_path]
+        file_path = _clean_path(file_path)
+        contents = ''
+        metadata = {}
+        mode = mode.replace('+', 'w')
+        with self._rwlock.reader:
+            file_obj = self._unwritten.get(file_path)
+            if file_obj is not None:
                 contents = file_obj.getvalue()
                 metadata = file_obj.metadata
-            else:
-                try:
-                    metadata, contents = self._get_file(file_path, version)
-                    if metadata.get('deleted'):
-                        if 'w' in mode or 'a' in mode:
-                            del metadata['deleted']
-                        raise OSError('File is deleted')
-                except (OSError, IOError, KeyError, ValueError) as e:
-                    if 'w' not in mode and 'a' not in mode:
-                        raise OSError('Error open(%s): %s' % (file_path, e))
-                    contents = ''
-            if 'r' not in mode and 'a' not in mode:
+        if file_obj is None:
+            # Not holding our lock here lets _get_file fetch the file
+            # on a spare connection while other threads use ours.
+            try:
+                metadata, contents = self._get_file(file_path, version)
+                if metadata.get('deleted'):
+                    if 'w' in mode or 'a' in mode:
+                        del metadata['deleted']
+                    raise OSError('File is deleted')
+            except (OSError, IOError, KeyError, ValueError) as e:
+                if 'w' not in mode and 'a' not in mode:
+                    raise OSError('Error open(%s): %s' % (file_path, e))
                 contents = ''
-            return Mailfile_File(self, file_path, mode, metadata, contents)
+        if 'r' not in mode and 'a' not in mode:
+            contents = ''
+        return Mailfile_File(self, file_path, mode, metadata, contents)
 
 
 if __name__ == "__main__":
@@ -13,122 +13,328 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with Mailfile. If not, see <https://www.gnu.org/licenses/>.
 #
+import bisect
+import errno
+import io
 import os
+import re
+import sqlite3
 import sys
-import threading
+import tempfile
+import time
+
+try:
+    # A C implementation; much cheaper than threading.RLock on Python 2.
+    from fastrlock.rlock import FastRLock as RLock
+except ImportError:
+    from threading import RLock
 
 
 DEBUGGING = True
 
+# Linux can create nameless files, which we can then link into place using
+# their /proc/self/fd/ name. Python 2's os.link cannot follow that symlink.
+_O_TMPFILE = getattr(os, 'O_TMPFILE', None) if (sys.version_info[0] > 2) else None
+
+_PARTIAL_RE = re.compile(r'BODY(?:\.PEEK)?\[\]<(\d+)\.(\d+)>')
+_FIELDS_RE = re.compile(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]', re.I)
+
 
-def _l(cmd, rv):
+def _l(cmd, rv, *args):
+    # Any args are formatted into cmd only if we are actually logging.
     if DEBUGGING:
+        if args:
+            cmd = cmd % args
         sys.stderr.write('%-40.40s %s\n' % (cmd, ('%s' % (rv,))[:45]))
     return rv
 
 
-class FilesystemIMAP(object):
+def _header_fields(fd, fields):
+    """Read the named header fields (with continuation lines)."""
+    lines = []
+    keep = False
+    for line in fd:
+        if line in (b'\r\n', b'\n'):
+            lines.append(line)
+            break
+        if line[:1] not in (b' ', b'\t'):
+            keep = any(line.lower().startswith(f) for f in fields)
+        if keep:
+            lines.append(line)
+    return b''.join(lines)
+
+
+def _parse_fetch_parts(message_parts):
+    """
+    Figure out what a FETCH is asking for: returns the name of the data
+    item to respond with, a list of header fields (or None) and an
+    (offset, length) tuple for partial fetches (or None).
+    """
+    partial = _PARTIAL_RE.search(message_parts)
+    fields = _FIELDS_RE.search(message_parts)
+    if fields:
+        what = 'BODY[HEADER.FIELDS (%s)]' % fields.group(1).upper()
+        return what, [f.lower() + ':' for f in fields.group(1).split()], None
+    elif partial:
+        offset, length = int(partial.group(1)), int(partial.group(2))
+        return 'BODY[]<%d>' % offset, None, (offset, length)
+    return 'BODY[]', None, None
+
+
+def _fix_eol(data):
+    # FilesystemIMAP stores bare LF, as Maildir tools expect, but some
+    # versions stored messages as given (CRLF); convert only if needed.
+    eol = data.find(b'\n')
+    if eol > 0 and data[eol - 1:eol] != b'\r':
+        data = data.replace(b'\n', b'\r\n')
+    return data
+
+
+class _MockIMAP(object):
+    """
+    Command dispatch and no-op commands shared by our mock IMAP servers.
+    """
+    _UID_COMMANDS = {
+        'SEARCH': '_uid_search',
+        'FETCH': 'fetch',
+        'STORE': 'store'}
+
+    def __init__(self):
+        self.response_data = {}
+
+    def response(self, code):
+        return self.response_data.pop(code, None)
+
+    def uid(self, command, *args):
+        method = self._UID_COMMANDS.get(command)
+        if method is None:
+            raise ValueError('Unknown command: %s' % command)
+        return getattr(self, method)(*args)
+
+    def _uid_search(self, *criteria):
+        return self.search(None, *criteria)
+
+    def noop(self): return _l('NOOP', ('OK', ['This is a noop']))
+    def close(self): return _l('CLOSE', ('OK', ['This is a noop']))
+    def logout(self): return _l('LOGOUT', ('OK', ['This is a noop']))
+    def expunge(self): return _l('EXPUNGE', ('OK', ['This is a noop']))
+
+
+class FilesystemIMAP(_MockIMAP):
     """
     This is a filesystem-backed "mock IMAP server" for use with Mailfile
     It works with a tree that looks surprisingly similar to a Maildir.
+    As in a Maildir, messages are stored with bare LF line endings.
     """
     def __init__(self, base_dir, port=None, sep=':', create=False):
+        _MockIMAP.__init__(self)
         self.sep = sep
+        self.fn_template = 'eml-%%8.8x%s2,%%s' % sep.replace('%', '%%')
         self.base_dir = base_dir
         self.selected = []
-        self.response_data = {}
-        self.lock = threading.RLock()
+        self.lock = RLock()
+        self.ls_cache = {}
+        self.use_tmpfile = (_O_TMPFILE is not None)
+        self.path_cache = {}
+        self.subdir_cache = {}
         self.create_mode = create if isinstance(create, int) else 0o700
         if create and not os.path.exists(base_dir):
             os.mkdir(base_dir, create_mode)
 
     def _path(self, path):
-        if path == '/':
-            return self.base_dir
-        else:
-            return os.path.join(self.base_dir, path)
+        mpath = self.path_cache.get(path)
+        if mpath is None:
+            if path == '/':
+                mpath = self.base_dir
+            else:
+                mpath = os.path.join(self.base_dir, path)
+            self.path_cache[path] = mpath
+        return mpath
+
+    def _subdirs(self, mpath):
+        """Return the paths of the cur/, new/ and tmp/ of a mailbox."""
+        subs = self.subdir_cache.get(mpath)
+        if subs is None:
+            subs = self.subdir_cache[mpath] = tuple(
+                os.path.join(mpath, sub) for sub in ('cur', 'new', 'tmp'))
+        return subs
 
     def _list(self, path):
+        """
+        Return a dict of seq -> (directory, filename) for a mailbox, so
+        messages can be opened without probing both cur/ and new/. Results
+        are cached until the modification time or size of cur/ or new/
+        changes, so the caller must not modify the dict.
+        """
+        subs = self._subdirs(path)[:2]
+        stamp = []
+        for sub in subs:
+            try:
+                st = os.stat(sub)
+                stamp.append((st.st_mtime, st.st_size))
+            except OSError:
+                stamp.append(None)
+        cached = self.ls_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        # Directory timestamps are coarse, so a listing made right after a
+        # change might miss a second change with the same timestamp. Only
+        # trust listings of directories which have been still for a while,
+        # but keep the others around for _fetch_list.
+        cacheable = all(
+            (st is None) or (time.time() - st[0] > 2) for st in stamp)
         results = {}
-        for sub in ('cur', 'new'):
-            sub = os.path.join(path, sub)
-            if os.path.isdir(sub):
+        for sub, st in zip(subs, stamp):
+            if st is not None:
                 results.update(dict(
-                    (self._fn_parse(fn)[0], fn)
+                    (int(fn[4:12], 16), (sub, fn))
                     for fn in os.listdir(sub) if fn[:4] == 'eml-'))
+        self.ls_cache[path] = ((stamp if cacheable else None), results)
         return results
 
+    def _outdated(self, path):
+        cached = self.ls_cache.get(path)
+        if cached is not None:
+            self.ls_cache[path] = (None, cached[1])
+
+    def _fetch_list(self, path, message_set):
+        """
+        Like _list, but FETCH only needs to know where the messages it was
+        asked for are. Messages never move once delivered, so any listing
+        we have will do, even an outdated one, if it has all of them. This
+        saves directory scans while a mailbox is busy.
+        """
+        cached = self.ls_cache.get(path)
+        if cached is None or '*' in message_set:
+            return self._list(path)
+        files = cached[1]
+        for part in message_set.split(','):
+            first, _, last = part.partition(':')
+            for seq in range(int(first), int(last or first) + 1):
+                if seq not in files:
+                    return self._list(path)
+        return files
+
+    def _uid_set(self, message_set, files):
+        ordered = None
+        for part in message_set.split(','):
+            if ':' in part:
+                if ordered is None:
+                    ordered = sorted(files)
+                first, last = part.split(':')
+                lo = bisect.bisect_left(ordered, int(first))
+                if last == '*':
+                    hi = len(ordered)
+                else:
+                    hi = bisect.bisect_right(ordered, int(last))
+                for seq in ordered[lo:hi]:
+                    yield seq
+            else:
+                yield int(part)
+
     def _fn_parse(self, fn):
-        seq, flags = fn[4:].split(self.sep)
-        return (int(seq, 16), flags[2:])
+        # Names are always formatted by _fn_fmt: eml-<8 hex digits><sep>2,
+        return (int(fn[4:12], 16), fn[12 + len(self.sep) + 2:])
 
     def _fn_fmt(self, seq, flags=None):
-        return 'eml-%8.8x%s2,%s' % (seq, self.sep, flags or '')
+        return self.fn_template % (seq, flags or '')
 
     def append(self, mailbox, flags, date_time, message):
         try:
-            with self.lock:
-                mpath = self._path(mailbox)
-                files = self._list(mpath)
-                if files:
-                    seq = max(files.keys()) + 1
-                else:
-                    seq = 1
-                newfn = self._fn_fmt(seq, flags)
-                files[seq] = newfn
-                with open(os.path.join(mpath, 'cur', newfn), 'w') as fd:
-                    fd.write(message.replace('\r\n', '\n'))
-                return _l('APPEND', ('OK', ['APPEND completed: %8.8x' % seq]))
+            mpath = self._path(mailbox)
+            # As in Maildir, messages are written to tmp/ and then linked
+            # into place, so nobody ever sees half a message. Only picking
+            # the UID and linking need our lock; threads can write and
+            # fsync their messages at the same time.
+            curdir, newdir, tmpdir = self._subdirs(mpath)
+            if not os.path.isdir(tmpdir):
+                os.mkdir(tmpdir, 0o700)
+            fd = tmpfn = dirfd = None
+            if self.use_tmpfile:
+                # Skips creating and removing a directory entry in tmp/
+                try:
+                    fd = os.open(tmpdir, _O_TMPFILE | os.O_WRONLY, 0o600)
+                except OSError:
+                    self.use_tmpfile = False  # Not supported by this fs
+            if fd is None:
+                fd, tmpfn = tempfile.mkstemp(prefix='eml-', dir=tmpdir)
+            fo = os.fdopen(fd, 'wb')
+            try:
+                if tmpfn is None:
+                    # Python only uses linkat(), which can follow the
+                    # /proc/self/fd/ link, when given a directory fd.
+                    dirfd = os.open(curdir, os.O_RDONLY)
+                fo.write(message.replace(b'\r\n', b'\n'))
+                fo.flush()
+                os.fsync(fd)
+                with self.lock:
+                    files = self._list(mpath)
+                    seq = (max(files) + 1) if files else 1
+                    # Other instances may be appending to the same mailbox
+                    # (our lock is per-instance); unlike rename(), link()
+                    # never overwrites an existing message.
+                    while True:
+                        newfn = self._fn_fmt(seq, flags)
+                        try:
+                            if dirfd is None:
+                                os.link(tmpfn, os.path.join(curdir, newfn))
+                            else:
+                                os.link('/proc/self/fd/%d' % fd, newfn,
+                                        dst_dir_fd=dirfd)
+                            break
+                        except OSError as e:
+                            if e.errno != errno.EEXIST:
+                                raise
+                            seq += 1
+                    self._outdated(mpath)
+            finally:
+                fo.close()
+                if dirfd is not None:
+                    os.close(dirfd)
+                if tmpfn is not None:
+                    os.remove(tmpfn)
+            return _l('APPEND', ('OK', ['APPEND completed: %8.8x' % seq]))
         except (IOError, OSError, ValueError, KeyError, IndexError) as e:
             return _l('APPEND', ('NO', ['APPEND failed: %s' % e]))
 
-    def response(self, code):
-        rv = self.response_data.get(code)
-        if code in self.response_data:
-            del self.response_data[code]
-        return rv
-
-    def uid(self, command, *args):
-        if command == 'SEARCH':
-            return self.search(None, *args)
-        if command == 'FETCH':
-            return self.fetch(*args)
-        if command == 'STORE':
-            return self.store(*args)
-        raise ValueError('Unknown command: %s' % command)
-
     def select(self, mailbox='INBOX', readonly=False):
         try:
             mpath = self._path(mailbox)
-            if not os.path.exists(mpath) or not os.path.isdir(mpath):
+            if not os.path.isdir(mpath):
                 raise OSError('Not a directory: %s' % mpath)
             self.response_data = {}
             message_count = len(self._list(mpath))
             self.selected = mailbox
-            return _l('SELECT %s' % mailbox, ('OK', [message_count]))
+            return _l('SELECT %s', ('OK', [message_count]), mailbox)
         except (IOError, OSError, ValueError, KeyError, IndexError) as e:
             return _l('SELECT', ('NO', ['No such mailbox: %s' % e]))
 
     def create(self, mailbox):
         try:
             mpath = self._path(mailbox)
-            if not os.path.exists(mpath) or not os.path.isdir(mpath):
+            if not os.path.isdir(mpath):
                 os.mkdir(mpath)
-                os.mkdir(os.path.join(mpath, 'cur'))
-                os.mkdir(os.path.join(mpath, 'new'))
-                os.mkdir(os.path.join(mpath, 'tmp'))
+                for sub in self._subdirs(mpath):
+                    os.mkdir(sub)
             return _l('CREATE', ('OK', ['Created %s' % mailbox]))
         except (IOError, OSError, ValueError, KeyError, IndexError) as e:
             return _l('CREATE', ('NO', ['Failed: %s' % e]))
 
     def search(self, charset, *criteria):
         try:
-            for c in criteria:
-                if c and c != 'ALL':
-                    raise ValueError('I am not very good at searching')
+            criteria = [c for c in criteria if c and c != 'ALL']
+            if criteria and (len(criteria) != 2 or criteria[0] != 'UID'):
+                raise ValueError('I am not very good at searching')
             with self.lock:
-                seqs = self._list(self._path(self.selected)).keys()
-                return _l('SEARCH', ('OK', [' '.join('%d' % s for s in seqs)]))
+                files = self._list(self._path(self.selected))
+                if criteria:
+                    seqs = list(self._uid_set(criteria[1], files))
+                    if files and not seqs and criteria[1].endswith(':*'):
+                        seqs = [max(files)]
+                else:
+                    seqs = files.keys()
+                return _l('SEARCH', ('OK', [' '.join(map(str, seqs))]))
         except (IOError, OSError, ValueError, KeyError, IndexError) as e:
             return _l('SEARCH', ('NO', ['Search failed: %s' % e]))
 
@@ -140,32 +346,256 @@ class FilesystemIMAP(object):
 
         mpath = self._path(self.selected)
         files = self._list(mpath)
-        for seq in (int(s) for s in message_set.split(',')):
+        for seq in self._uid_set(message_set, files):
             if seq not in files:
                 continue
-            for sub in ('cur', 'new'):
-                fn = os.path.join(mpath, sub, files[seq])
-                if os.path.exists(fn):
-                    os.remove(fn)
-        return _l(
-            'STORE %s %s %s' % (message_set, command, flags),
-            ('OK', [message_set]))
+            try:
+                os.remove(os.path.join(*files[seq]))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self._outdated(mpath)
+        return _l('STORE %s %s %s', ('OK', [message_set]),
+                  message_set, command, flags)
 
     def fetch(self, message_set, message_parts):
+        error = 'No such message'
+        results = []
+        what, fields, partial = _parse_fetch_parts(message_parts)
+        mpath = self._path(self.selected)
+        files = self._fetch_list(mpath, message_set)
+        for seq in self._uid_set(message_set, files):
+            try:
+                with open(os.path.join(*files[seq]), 'rb') as fd:
+                    if fields:
+                        data = _header_fields(fd, fields)
+                    elif partial:
+                        # Offsets are in CRLF terms, but every byte on disk
+                        # is at least one byte of the message; so this is
+                        # all we need to read.
+                        data = fd.read(partial[0] + partial[1])
+                    else:
+                        data = fd.read()
+                data = _fix_eol(data)
+                if partial:
+                    data = data[partial[0]:partial[0] + partial[1]]
+                results.append((
+                    '%d (UID %d %s {%d}' % (seq, seq, what, len(data)),
+                    data))
+                results.append(')')
+            except (IOError, OSError, ValueError, KeyError, IndexError) as e:
+                error = e
+        if results:
+            return _l('FETCH %s %s', ('OK', results),
+                      message_set, message_parts)
+        return _l('FETCH', ('NO', ['Fetch failed: %s' % error]))
+
+
+class SQLiteIMAP(_MockIMAP):
+    """
+    Another "mock IMAP server" for use with Mailfile, which keeps all its
+    mailboxes in a single SQLite database. Storing lots of small files
+    this way is much cheaper than creating, listing and opening one file
+    on disk per message, as FilesystemIMAP does.
+
+    UIDs are allocated from a per-mailbox counter, so they are never
+    reused, even if the newest message gets deleted.
+    """
+    _HEADER_PEEK = 8192
+    _SET_CHUNK = 500
+
+    def __init__(self, db_path, port=None, create=False):
+        if not os.path.exists(db_path):
+            if not create:
+                raise IOError('No such database: %s' % db_path)
+            os.close(os.open(db_path, os.O_WRONLY | os.O_CREAT,
+                             0o600 if (create is True) else create))
+        _MockIMAP.__init__(self)
+        self.db_path = db_path
+        self.selected = None
+        self.lock = RLock()
+        # We do our own transactions (isolation_level=None), and other
+        # instances may be using the same database, hence the timeout.
+        self.db = sqlite3.connect(
+            db_path, timeout=30, isolation_level=None,
+            check_same_thread=False)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS mailboxes ('
+                ' name TEXT PRIMARY KEY, next_uid INTEGER NOT NULL)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                ' mailbox TEXT, seq INTEGER, flags TEXT, body BLOB,'
+                ' PRIMARY KEY (mailbox, seq))')
+
+    def _where_chunks(self, message_set):
+        """
+        Convert an IMAP message set to a list of SQL conditions, each
+        covering at most _SET_CHUNK parts of the set; SQLite limits how
+        deep an expression (such as a long chain of ORs) may be.
+        """
+        parts = message_set.split(',')
+        return [self._where(parts[i:i + self._SET_CHUNK])
+                for i in range(0, len(parts), self._SET_CHUNK)]
+
+    def _where(self, parts):
+        """
+        Convert parts of an IMAP message set to an SQL condition. Every
+        number is converted using int(), so it is safe to inline them.
+        """
+        seqs = []
+        clauses = []
+        for part in parts:
+            if ':' in part:
+                first, last = part.split(':')
+                if last == '*':
+                    clauses.append('seq >= %d' % int(first))
+                else:
+                    clauses.append(
+                        'seq BETWEEN %d AND %d' % (int(first), int(last)))
+            else:
+                seqs.append('%d' % int(part))
+        if seqs:
+            clauses.append('seq IN (%s)' % ','.join(seqs))
+        return '(%s)' % ' OR '.join(clauses)
+
+    def _exists(self, mailbox):
+        return self.db.execute(
+            'SELECT 1 FROM mailboxes WHERE name = ?', (mailbox,)
+            ).fetchone() is not None
+
+    def append(self, mailbox, flags, date_time, message):
         try:
-            seq = int(message_set)
-            mpath = self._path(self.selected)
-            files = self._list(mpath)
-            for sub in ('cur', 'new'):
-                fn = os.path.join(mpath, sub, files[seq])
-                data = open(fn, 'rb').read().replace('\n', '\r\n')
-                return _l(
-                    'FETCH %s %s' % (message_set, message_parts),
-                    ('OK', [['', data]]))
-        except (IOError, OSError, ValueError, KeyError, IndexError) as e:
-            pass
-        return _l('FETCH', ('NO', ['Fetch failed: %s' % e]))
+            with self.lock:
+                self.db.execute('BEGIN IMMEDIATE')
+                try:
+                    row = self.db.execute(
+                        'SELECT next_uid FROM mailboxes WHERE name = ?',
+                        (mailbox,)).fetchone()
+                    if row is None:
+                        raise KeyError('No such mailbox: %s' % mailbox)
+                    seq = row[0]
+                    self.db.execute(
+                        'UPDATE mailboxes SET next_uid = ? WHERE name = ?',
+                        (seq + 1, mailbox))
+                    self.db.execute(
+                        'INSERT INTO messages (mailbox, seq, flags, body)'
+                        ' VALUES (?, ?, ?, ?)',
+                        (mailbox, seq, flags or '', sqlite3.Binary(message)))
+                    self.db.execute('COMMIT')
+                except Exception:
+                    self.db.execute('ROLLBACK')
+                    raise
+                return _l('APPEND', ('OK', ['APPEND completed: %8.8x' % seq]))
+        except (sqlite3.Error, ValueError, KeyError) as e:
+            return _l('APPEND', ('NO', ['APPEND failed: %s' % e]))
 
-    def close(self): return _l('CLOSE', ('OK', ['This is a noop']))
-    def logout(self): return _l('LOGOUT', ('OK', ['This is a noop']))
-    def expunge(self): return _l('EXPUNGE', ('OK', ['This is a noop']))
+    def select(self, mailbox='INBOX', readonly=False):
+        try:
+            with self.lock:
+                if not self._exists(mailbox):
+                    raise KeyError(mailbox)
+                (message_count,) = self.db.execute(
+                    'SELECT COUNT(*) FROM messages WHERE mailbox = ?',
+                    (mailbox,)).fetchone()
+            self.response_data = {}
+            self.selected = mailbox
+            return _l('SELECT %s', ('OK', [message_count]), mailbox)
+        except (sqlite3.Error, KeyError) as e:
+            return _l('SELECT', ('NO', ['No such mailbox: %s' % e]))
+
+    def create(self, mailbox):
+        try:
+            with self.lock:
+                self.db.execute(
+                    'INSERT OR IGNORE INTO mailboxes (name, next_uid)'
+                    ' VALUES (?, 1)', (mailbox,))
+            return _l('CREATE', ('OK', ['Created %s' % mailbox]))
+        except sqlite3.Error as e:
+            return _l('CREATE', ('NO', ['Failed: %s' % e]))
+
+    def search(self, charset, *criteria):
+        try:
+            criteria = [c for c in criteria if c and c != 'ALL']
+            if criteria and (len(criteria) != 2 or criteria[0] != 'UID'):
+                raise ValueError('I am not very good at searching')
+            sql = 'SELECT seq FROM messages WHERE mailbox = ?'
+            wheres = self._where_chunks(criteria[1]) if criteria else ['1']
+            with self.lock:
+                seqs = sorted(row[0] for where in wheres
+                              for row in self.db.execute(
+                                  sql + ' AND ' + where, (self.selected,)))
+                if not seqs and criteria and criteria[1].endswith(':*'):
+                    # n:* always matches the newest message
+                    seqs = [row[0] for row in self.db.execute(
+                        'SELECT MAX(seq) FROM messages WHERE mailbox = ?',
+                        (self.selected,)) if row[0] is not None]
+            return _l('SEARCH', ('OK', [' '.join(map(str, seqs))]))
+        except (sqlite3.Error, ValueError) as e:
+            return _l('SEARCH', ('NO', ['Search failed: %s' % e]))
+
+    def store(self, message_set, command, flags):
+        if command not in ('+FLAGS', '+FLAGS.SILENT'):
+            raise ValueError('I do not know how to %s' % command)
+        if flags not in ('(\Deleted)', ):
+            raise ValueError('I do not know how to set %s' % flags)
+        try:
+            with self.lock:
+                self.db.execute('BEGIN IMMEDIATE')
+                try:
+                    for where in self._where_chunks(message_set):
+                        self.db.execute(
+                            'DELETE FROM messages WHERE mailbox = ? AND '
+                            + where, (self.selected,))
+                    self.db.execute('COMMIT')
+                except Exception:
+                    self.db.execute('ROLLBACK')
+                    raise
+        except (sqlite3.Error, ValueError) as e:
+            return _l('STORE', ('NO', ['STORE failed: %s' % e]))
+        return _l('STORE %s %s %s', ('OK', [message_set]),
+                  message_set, command, flags)
+
+    def fetch(self, message_set, message_parts):
+        what, fields, partial = _parse_fetch_parts(message_parts)
+        if fields:
+            # Only our headers are needed, which are rarely large; fall
+            # back to the full body below if they do not fit.
+            column = 'substr(body, 1, %d)' % self._HEADER_PEEK
+        elif partial:
+            column = 'substr(body, %d, %d)' % (partial[0] + 1, partial[1])
+        else:
+            column = 'body'
+        results = []
+        try:
+            with self.lock:
+                rows = []
+                for where in self._where_chunks(message_set):
+                    rows.extend(self.db.execute(
+                        'SELECT seq, %s FROM messages WHERE mailbox = ?'
+                        ' AND %s' % (column, where), (self.selected,)))
+                rows.sort(key=lambda row: row[0])
+                for seq, data in rows:
+                    data = bytes(data)
+                    if fields:
+                        if (len(data) >= self._HEADER_PEEK and
+                                b'\n\r\n' not in data and
+                                b'\n\n' not in data):
+                            data = bytes(self.db.execute(
+                                'SELECT body FROM messages'
+                                ' WHERE mailbox = ? AND seq = ?',
+                                (self.selected, seq)).fetchone()[0])
+                        data = _header_fields(io.BytesIO(data), fields)
+                    data = _fix_eol(data)
+                    results.append((
+                        '%d (UID %d %s {%d}' % (seq, seq, what, len(data)),
+                        data))
+                    results.append(')')
+        except (sqlite3.Error, ValueError) as e:
+            return _l('FETCH', ('NO', ['Fetch failed: %s' % e]))
+        if results:
+            return _l('FETCH %s %s', ('OK', results),
+                      message_set, message_parts)
+        return _l('FETCH', ('NO', ['Fetch failed: No such message']))
@@ -19,16 +19,55 @@ Command Line Interface for interacting with Mailfile filesystems.
 Run `python -m mailfile help` for instructions.
 """
 import base64
+import bisect
 import getopt
 import getpass
-import hashlib
+import heapq
 import imaplib
+import itertools
 import json
 import os
+import socket
 import sys
 
-from . import Mailfile
-from .backends import FilesystemIMAP
+from . import Mailfile, _clean_path, _json_dumps, _json_loads
+from .backends import FilesystemIMAP, SQLiteIMAP
+
+
+# Files are copied in chunks of this size, rather than read in one go.
+_COPY_CHUNK = 1 << 20
+
+# Logged in Mailfile objects, so commands run in one process share them.
+_MAILFILES = {}
+
+# The decoded login file, keyed by its path, modification time and size.
+_CREDS_CACHE = {}
+
+
+# Short options, and synonyms, mapped to the long option they stand for.
+_OPT_ALIASES = {
+    '-a': '--all',
+    '-f': '--force',
+    '-l': '--long',
+    '--metadata': '--long',
+    '-r': '--recurse',
+    '-v': '--verbose',
+    '-V': '--version'}
+
+
+def _canon_opts(opts):
+    """Convert getopt output to a dict, keyed by long option names."""
+    return dict((_OPT_ALIASES.get(k, k), v) for k, v in opts)
+
+
+def _copy(src, dst, buf):
+    """Copy from one file to another, reusing the bytearray buf."""
+    view = memoryview(buf)
+    while True:
+        count = src.readinto(buf)
+        if not count:
+            break
+        dst.write(view[:count])
 
 
 def _fail(msg, code=1):
@@ -42,49 +81,78 @@ def _loginfile():
 
 def _load_creds():
     try:
-        creds = {}
-        with open(_loginfile(), 'r') as fd:
-            creds.update(json.loads(base64.b64decode(fd.read())))
-        return creds
-    except (OSError, IOError, ValueError):
+        st = os.stat(_loginfile())
+        stamp = (_loginfile(), st.st_mtime, st.st_size)
+        if stamp not in _CREDS_CACHE:
+            with open(_loginfile(), 'rb') as fd:
+                loaded = _json_loads(base64.b64decode(fd.read()))
+            _CREDS_CACHE.clear()
+            _CREDS_CACHE[stamp] = loaded
+        # Callers modify the credentials, so they get a copy
+        return dict(_CREDS_CACHE[stamp])
+    except (OSError, IOError, ValueError, TypeError):
         return None
 
 
+def _save_creds(creds):
+    _CREDS_CACHE.clear()
+    # Create the file private, so it is never readable by others; the
+    # chmod covers files created by older versions.
+    fd = os.open(_loginfile(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'wb') as fd:
+        fd.write(base64.b64encode(_json_dumps(creds).encode('utf-8')))
+
+
 def _get_mailfile(creds=None):
     if creds is None:
         creds = _load_creds()
         if creds is None:
             _fail('Please log in first.', code=2)
 
+    cache_key = (creds['imap'], creds.get('username'), creds['mailbox'],
+                 creds.get('key'))
+    mailfile = _MAILFILES.get(cache_key)
+    if mailfile is not None:
+        try:
+            if mailfile.imap.noop()[0] == 'OK':
+                return mailfile
+        except (imaplib.IMAP4.error, socket.error):
+            pass
+        del _MAILFILES[cache_key]
+
     host, port = creds['imap'].split(':')
     if host == 'maildir':
-        imap = FilesystemIMAP(port, create=0o700)
+        def connect():
+            return FilesystemIMAP(port, create=0o700)
+    elif host == 'sqlite':
+        def connect():
+            return SQLiteIMAP(port, create=0o600)
     else:
         port = int(port)
         while not creds.get('password'):
             creds['password'] = getpass.getpass(
                 'IMAP password for %(username)s@%(imap)s: ' % creds).strip()
-        try:
+        def connect():
             cls = (imaplib.IMAP4 if (port == 143) else imaplib.IMAP4_SSL)
             imap = cls(host, port)
             imap.login(creds['username'], creds['password'])
-        except cls.error as e:
-            _fail('IMAP login failed: %s' % e, code=3)
+            return imap
+
+    try:
+        imap = connect()
+    except imaplib.IMAP4.error as e:
+        _fail('IMAP login failed: %s' % e, code=3)
 
-    mailfile = Mailfile(imap, creds['mailbox'])
+    # The factory lets Mailfile open extra connections, to upload or
+    # download multiple files in parallel.
+    mailfile = Mailfile(imap, creds['mailbox'], imap_factory=connect)
     if creds['key'] and creds['key'] != 'None':
         mailfile.set_encryption_key(creds['key'])
+    _MAILFILES[cache_key] = mailfile
     return mailfile
 
 
-def _clean_path(path):
-    while path[:1] == '/':
-        path = path[1:]
-    while path[-1:] == '/':
-        path = path[:-1]
-    return path.replace('//', '/')
-
-
 def _put_command(opts, args):
     """Put a file or files in Mailfile (upload)
 
@@ -95,23 +163,27 @@ Options:
 The last argument should be the destination directory."""
 # FIXME:  -r, --recurse     Upload entire directory trees
     dest = _clean_path(args.pop(-1))
-    opts = dict(opts)
+    opts = _canon_opts(opts)
+    verbose = ('--verbose' in opts)
     for fn in args:
         if not os.path.exists(fn):
             raise OSError("File not found: %s" % fn)
     if not args:
         return True
+    buf = bytearray(_COPY_CHUNK)
     with _get_mailfile() as mailfile:
         for fn in args:
             if dest:
                 dest_fn = os.path.join(dest, os.path.basename(fn))
             else:
                 dest_fn = os.path.basename(fn)
-            with open(fn, 'r') as fd:
-                data = fd.read()
-            with mailfile.open(dest_fn, 'w') as fd:
-                fd.write(data)
-            if '--verbose' in opts or '-v' in opts:
+            with open(fn, 'rb', _COPY_CHUNK) as src:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(
+                        src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                with mailfile.open(dest_fn, 'w') as fd:
+                    _copy(src, fd, buf)
+            if verbose:
                 print("%s -> mailfile:%s" % (fn, dest_fn))
     return True
 
@@ -135,56 +207,72 @@ specific version, it doesn't make sense to request multiple files."""
     dest_dir = args.pop(-1)
     if not os.path.exists(dest_dir) or not os.path.isdir(dest_dir):
          _fail('Not a directory: %s' % dest_dir)
+    args = [fn.lstrip('/') for fn in args]
     mailfile = _get_mailfile()
 
     full_path = False
     def _fn(fn):
-        while fn[:1] == '/':
-            fn = fn[1:]
         if full_path:
             target = os.path.join(dest_dir, fn)
         else:
             target = os.path.join(dest_dir, os.path.basename(fn))
         return target
 
+    made_dirs = set()
     def _pmkdir(fn):
         dn = os.path.dirname(fn)
-        if not os.path.exists(dn):
-            if dn and fn != dn:
-                _pmkdir(dn)
-                os.mkdir(dn)
-
-    opts = dict(opts)
-    if '--recurse' in opts or '-r' in opts:
+        if dn and dn not in made_dirs:
+            if not os.path.isdir(dn):
+                os.makedirs(dn)
+            made_dirs.add(dn)
+
+    opts = _canon_opts(opts)
+    verbose = ('--verbose' in opts)
+    if '--recurse' in opts:
         full_path = True
-        files = []
+        runs = []
         with mailfile:
-            ls = sorted(mailfile._tree.keys())
+            ls = mailfile._sorted_tree_paths()
         for prefix in args:
-            while prefix[:1] == '/':
-                prefix = prefix[1:]
-            files.extend([f for f in ls if f.startswith(prefix)])
-        args = sorted(list(set(files)))
-
-    if '--force' not in opts and '-f' not in opts:
+            # ls is sorted, so matching files are all in one run
+            first = last = bisect.bisect_left(ls, prefix)
+            while last < len(ls) and ls[last].startswith(prefix):
+                last += 1
+            runs.append(ls[first:last])
+        # Merging sorted runs keeps them sorted, groupby drops duplicates
+        args = [fn for fn, _ in itertools.groupby(heapq.merge(*runs))]
+
+    if '--force' not in opts:
         for fn in args:
             target = _fn(fn)
             if os.path.exists(target):
                 _fail('Cravenly refusing to overwrite %s' % target)
 
-    version = int(opts.get('-V', opts.get('--version', 0))) or None
+    version = int(opts.get('--version', 0)) or None
     if version and len(args) > 1:
         _fail('Multiple files and --version are incompatible.')
-    with mailfile:
+    if full_path:
+        # Create all the directories up front, before any downloading
         for fn in args:
-            while fn[:1] == '/':
-                fn = fn[1:]
+            _pmkdir(_fn(fn))
+
+    buf = bytearray(_COPY_CHUNK)
+    with mailfile:
+        if len(args) > 1:
+            # Fetch many files with few round-trips
+            items = mailfile.read_many(args, version=version)
+        else:
+            items = [(fn, None) for fn in args]
+        for fn, data in items:
             target = _fn(fn)
-            if full_path:
-                _pmkdir(target)
-            data = mailfile.open(fn, 'r', version=version).read()
-            open(target, 'w').write(data)
-            if '--verbose' in opts or '-v' in opts:
+            if data is not None:
+                with open(target, 'wb', _COPY_CHUNK) as fd:
+                    fd.write(data)
+            else:
+                with mailfile.open(fn, 'r', version=version) as src:
+                    with open(target, 'wb', _COPY_CHUNK) as fd:
+                        _copy(src, fd, buf)
+            if verbose:
                 print("mailfile:%s -> %s" % (fn, target))
     return True
 
@@ -198,16 +286,20 @@ Options:
 
 When requesting a specific version, it doesn't make sense to request
 multiple files."""
-    opts = dict(opts)
-    version = int(opts.get('-V', opts.get('--version', 0))) or None
+    opts = _canon_opts(opts)
+    version = int(opts.get('--version', 0)) or None
     if version and len(args) > 1:
         _fail('Multiple files and --version are incompatible.')
+    # File contents are bytes, so bypass any text encoding on stdout
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
     with _get_mailfile() as mailfile:
-        for fn in args:
-            while fn[:1] == '/':
-                fn = fn[1:]
-            with mailfile.open(fn, 'r', version=version) as fd:
-                sys.stdout.write(fd.read())
+        if len(args) > 1:
+            for fn, data in mailfile.read_many(args, version=version):
+                stdout.write(data)
+        else:
+            for fn in args:
+                with mailfile.open(fn, 'r', version=version) as fd:
+                    stdout.write(fd.read())
     return True
 
 
@@ -217,7 +309,7 @@ def _vers_command(opts, args):
 Example: python -m mailfile vers 4 /tmp/README.md
 
 """
-    opts = dict(opts)
+    opts = _canon_opts(opts)
     versions = int(args.pop(0))
     with _get_mailfile() as mailfile:
         for fn in args:
@@ -236,8 +328,8 @@ Options:
 
 Note: removing the deletion marker will undelete the file!
 """
-    opts = dict(opts)
-    version = int(opts.get('-V', opts.get('--version', 0)))
+    opts = _canon_opts(opts)
+    version = int(opts.get('--version', 0))
     if version and len(args) != 1:
         _fail('Multiple files and --version are incompatible.')
     with _get_mailfile() as mailfile:
@@ -257,37 +349,44 @@ Options:
 
 Defaults to listing the root directory, if any arguments are present it
 will list those directories instead."""
-    opts = dict(opts)
+    opts = _canon_opts(opts)
 
-    verbose = ('-l' in opts or '--long' in opts or '--metadata' in opts)
+    verbose = ('--long' in opts)
     def _ls(mailfile, files):
         if verbose:
             ll = max(len(f) for f in files)
             fmt = '%%-%d.%ds %%s' % (ll, ll)
+            encode = json.JSONEncoder(sort_keys=True).encode
+            lines = []
             for f in files:
                 if f in ('.', '..'):
                     continue
                 if f in mailfile._tree:
-                    print(fmt % (f, json.dumps({
+                    lines.append(fmt % (f, encode({
                         'metadata': mailfile._tree[f][1],
-                        'versions': sorted(list(mailfile._tree[f][2]))},
-                        sort_keys=True)))
+                        'versions': sorted(mailfile._tree[f][2])})))
                 else:
-                    print(fmt % (f, '{}'))
+                    lines.append(fmt % (f, '{}'))
+            if lines:
+                print('\n'.join(lines))
         else:
             print('\n'.join(files))
 
     with _get_mailfile() as mailfile:
-        if '-a' in opts or '--all' in opts:
-            flist = sorted(mailfile._tree.keys())
+        # These are all sorted already, unless we merge multiple listings
+        if '--all' in opts:
+            flist = mailfile._sorted_tree_paths()
         elif not args:
             flist = mailfile.listdir('/')
+        elif len(args) == 1:
+            flist = mailfile.listdir(args[0])
         else:
             flist = []
             for prefix in args:
                 flist.extend(mailfile.listdir(prefix))
+            flist = sorted(set(flist))
         if flist:
-            _ls(mailfile, sorted(list(set(flist))))
+            _ls(mailfile, flist)
     return True
 
 
@@ -297,6 +396,8 @@ def _mount_command(opts, args):
 Example: python -m mailfile mount ./tmp
 Options:
     -v, --verbose     Log activity to STDERR.
+    --attr-timeout=N  Let the kernel cache file attributes for N seconds,
+                      defaults to 10.
 
 The process will hang, you can put it in the background yourself if you
 prefer."""
@@ -304,9 +405,11 @@ prefer."""
         from .fuse_driver import mount
     except ImportError as e:
         _fail('Is fusepy installed? Error: %s' % e, 98)
-    opts = dict(opts)
-    verbose = ('-v' in opts or '--verbose' in opts)
-    mount(_get_mailfile(), args[0], verbose=verbose)
+    opts = _canon_opts(opts)
+    verbose = ('--verbose' in opts)
+    attr_timeout = float(opts.get('--attr-timeout', 10))
+    mount(_get_mailfile(), args[0], verbose=verbose,
+          attr_timeout=attr_timeout)
     return True
 
 
@@ -319,9 +422,7 @@ hand if you want them gone too.
 """
     creds = _load_creds()
     del creds['password']
-    with open(_loginfile(), 'w') as fd:
-        os.chmod(_loginfile(), 0o600)
-        fd.write(base64.encodestring(json.dumps(creds)))
+    _save_creds(creds)
     sys.stderr.write('OK: Deleted password from %s\n' % _loginfile())
     return True
 
@@ -340,20 +441,21 @@ If the key is set to the string "None" (without the quotes), that
 will disable Mailfile's encryption.
 
 Setting the IMAP server to maildir:/path/to/folder will use the
-built-in local Maildir storage, instead of real IMAP.
+built-in local Maildir storage, instead of real IMAP. Similarly,
+sqlite:/path/to/file.db keeps everything in a local SQLite database.
 
 Warning: This will store your IMAP and Mailfile access credentials,
 lightly obfuscated, in ~/.mailfile-login. Use the logout command to
 delete the IMAP password from this file."""
     defaults = _load_creds() or {}
-    opts = dict(opts)
+    opts = _canon_opts(opts)
     creds = {
         'imap': opts.get('--imap', defaults.get('imap', 'localhost:143')),
         'mailbox': opts.get('--mailbox', defaults.get('mailbox', 'FILE_STORAGE')),
         'username': opts.get('--username', defaults.get('username', os.getenv('USER'))),
         'password': opts.get('--password', defaults.get('password')),
         'key': opts.get('--key', defaults.get('key'))}
-    if not creds['imap'].startswith('maildir:'):
+    if creds['imap'].split(':')[0] not in ('maildir', 'sqlite'):
         while not creds['password']:
             creds['password'] = getpass.getpass(
                 'IMAP password for %(username)s@%(imap)s: ' % creds).strip()
@@ -363,9 +465,7 @@ delete the IMAP password from this file."""
 
     _get_mailfile(creds).synchronize()
 
-    with open(_loginfile(), 'w') as fd:
-        os.chmod(_loginfile(), 0o600)
-        fd.write(base64.encodestring(json.dumps(creds)))
+    _save_creds(creds)
     return True
 
 
@@ -375,7 +475,7 @@ def _help_command(opts, args):
 You can get further instructions on each command by running
 `help command`."""
     for cmd in args:
-        print('%s: %s' % (cmd, dict(_COMMANDS)[cmd][0].__doc__))
+        print('%s: %s' % (cmd, _COMMANDS_MAP[cmd][0].__doc__))
     if not args:
         print("""\
 This is the Command Line Interface for Mailfile filesystems
@@ -389,9 +489,7 @@ Examples:
     python -m mailfile help login
     python -m mailfile cat /project/README.md
     python -m mailfile ls -l
-""" % {'commands': '\n'.join([
-            '    %-10.10s %s' % (cmd, synopsis[0].__doc__.splitlines()[0])
-            for cmd, synopsis in _COMMANDS])})
+""" % {'commands': _HELP_COMMANDS})
     return True
 
 
@@ -404,15 +502,19 @@ _COMMANDS = [
     ('cat',    (_cat_command,    'V:',    ['version='])),
     ('rm',     (_rm_command,     'V:',    ['version='])),
     ('vers',   (_vers_command,   '',      [])),
-    ('mount',  (_mount_command,  'v',     ['verbose'])),
+    ('mount',  (_mount_command,  'v',     ['verbose', 'attr-timeout='])),
     ('login',  (_login_command,  '',      ['imap=', 'username=', 'mailbox=',
                                            'password=', '--key='])),
     ('logout', (_logout_command, '',     []))]
+_COMMANDS_MAP = dict(_COMMANDS)
+_HELP_COMMANDS = '\n'.join(
+    '    %-10.10s %s' % (cmd, synopsis[0].__doc__.splitlines()[0])
+    for cmd, synopsis in _COMMANDS)
 
 
 def cli():
     try:
-        cmd, shortlist, longlist = dict(_COMMANDS)[sys.argv[1]]
+        cmd, shortlist, longlist = _COMMANDS_MAP[sys.argv[1]]
         if not cmd(*getopt.getopt(sys.argv[2:], shortlist, longlist)):
             sys.exit(1)
     except KeyboardInterrupt:
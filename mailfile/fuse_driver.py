@@ -25,21 +25,48 @@ have a concept of directories.
 """
 import errno
 import fcntl
+import itertools
 import os
 import stat
 import sys
+import threading
 import time
 
 from fusepy import FUSE, FuseOSError, Operations
 
 
+# Mailfile.open() modes for the access mode and append bits of open(2)
+# flags. O_RDONLY is zero, so it cannot be tested for with a bitwise and.
+_MODE_FLAGS = os.O_APPEND | os.O_RDWR | os.O_WRONLY
+_MODES = {
+    0: 'r',
+    os.O_APPEND: 'r',
+    os.O_RDWR: 'r+',
+    os.O_APPEND | os.O_RDWR: 'ar+',
+    os.O_WRONLY: 'w',
+    os.O_APPEND | os.O_WRONLY: 'a'}
+
+
 class Mailfile_Fuse(Operations):
+    _STATFS_TTL = 10
+    _READDIR_SYNC_TTL = 5
+
     def __init__(self, mailfile, verbose):
         self.root = '/tmp'
         self.mailfile = mailfile
         self.verbose = verbose
+        self.uid = os.getuid()
+        self.gid = os.getgid()
         self.fhs = {}
+        self.path_fhs = {}
+        self.fh_counter = itertools.count(1)
         self.stat_cache = {}
+        self.statfs_cache = (0, None)
+        self.synced = 0
+        # FUSE calls us from many threads. The Mailfile does its own locking,
+        # this lock guards our file handles and stat cache, and each open
+        # file handle has a lock of its own.
+        self.lock = threading.Lock()
 
     def _l(self, msg, stuff=None):
         if self.verbose:
@@ -50,7 +77,7 @@ class Mailfile_Fuse(Operations):
         now = int(time.time())
         return {
             'st_ctime': now, 'st_atime': now,
-            'st_gid': os.getgid(), 'st_uid': os.getuid(),
+            'st_gid': self.gid, 'st_uid': self.uid,
             'st_size': 0, 'st_nlink': 1,
             'st_mode': mode}
 
@@ -63,32 +90,62 @@ class Mailfile_Fuse(Operations):
     def chown(self, path, uid, gid):
         return self._l('chown(%s, %s, %s)' % (path, uid, gid), 0)
 
+    def _fh(self, fh):
+        with self.lock:
+            return self.fhs[fh]
+
     def mkdir(self, path, mode):
-        self.stat_cache[path] = self._make_stat(stat.S_IFDIR | mode)
+        with self.lock:
+            self.stat_cache[path] = self._make_stat(stat.S_IFDIR | mode)
         return self._l('mkdir(%s, %s)' % (path, mode), 0)
 
     def getattr(self, path, fh=None):
-        self._l('getattr(%s, %s)' % (path, fh))
+        # This is a hot path; avoid formatting log messages nobody reads.
+        verbose = self.verbose
+        if verbose:
+            self._l('getattr(%s, %s)' % (path, fh))
         try:
             stat = self.mailfile.lstat(path)
-            if path in self.stat_cache:
-                del self.stat_cache[path]
-            return self._l(' -> %s' % stat, stat)
+            with self.lock:
+                self.stat_cache.pop(path, None)
         except Exception as e:
-            if path in self.stat_cache:
-                return self._l(
-                    ' -> %s' % self.stat_cache[path], self.stat_cache[path])
-            self._l(' -> %s' % (e,))
-            raise FuseOSError(errno.ENOENT)
+            with self.lock:
+                stat = self.stat_cache.get(path)
+            if stat is None:
+                self._l(' -> %s' % (e,))
+                raise FuseOSError(errno.ENOENT)
+            stat = dict(stat)
+        if path in self.path_fhs:
+            # Files being written have not been uploaded yet, report the
+            # size of what has been written so far.
+            size = self._written_size(path)
+            if size is not None:
+                stat['st_size'] = size
+        if verbose:
+            self._l(' -> %s' % stat)
+        return stat
+
+    def _written_size(self, path):
+        with self.lock:
+            handles = [self.fhs[h] for h in self.path_fhs.get(path, ())]
+        sizes = []
+        for fn, fd, lock in handles:
+            if 'w' in fd._open_mode or 'a' in fd._open_mode:
+                with lock:
+                    sizes.append(len(fd))
+        return max(sizes) if sizes else None
 
     def readdir(self, path, fh):
         self._l('readdir(%s, %s)' % (path, fh))
         try:
-            self.mailfile.synchronize()
+            # Listing a large directory tends to come in bursts of calls,
+            # only check the server for news every few seconds.
+            if self.synced < time.time() - self._READDIR_SYNC_TTL:
+                self.mailfile.synchronize()
+                self.synced = time.time()
             dirents = self.mailfile.listdir(path)
             self._l(' -> %s' % (dirents,))
-            for d in dirents:
-                yield d
+            return dirents
         except Exception as e:
             self._l(' -> %s' % (e,))
             raise FuseOSError(errno.ENOENT)
@@ -107,10 +164,15 @@ class Mailfile_Fuse(Operations):
 
     def statfs(self, path):
         self._l('statfs(%s)' % (path,))
-        stv = os.statvfs('/')
-        return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree',
-            'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files', 'f_flag',
-            'f_frsize', 'f_namemax'))
+        # Desktops poll this a lot; the answer is neither exact nor urgent.
+        ts, result = self.statfs_cache
+        if ts < time.time() - self._STATFS_TTL:
+            stv = os.statvfs('/')
+            result = dict((key, getattr(stv, key)) for key in ('f_bavail',
+                'f_bfree', 'f_blocks', 'f_bsize', 'f_favail', 'f_ffree',
+                'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
+            self.statfs_cache = (time.time(), result)
+        return dict(result)
 
     def unlink(self, path):
         self._l('unlink(%s)' % (path,))
@@ -139,23 +201,17 @@ class Mailfile_Fuse(Operations):
     # ============
 
     def _modestring(self, flags):
-        modes = ''
-        if flags & os.O_APPEND:
-            modes += 'a'
-        if flags & os.O_RDWR:
-            modes += 'r+'
-        elif flags & os.O_RDONLY:
-            modes = 'r'
-        elif flags & os.O_WRONLY:
-            modes = 'w'
-        return (modes or 'r')
+        return _MODES.get(flags & _MODE_FLAGS, 'r')
 
     def open(self, path, flags):
         self._l('open(%s, %s)' % (path, flags))
         try:
             self.mailfile.synchronize()
-            fh = len(self.fhs) + 1
-            self.fhs[fh] = (path, self.mailfile.open(path, self._modestring(flags)))
+            fobj = self.mailfile.open(path, self._modestring(flags))
+            with self.lock:
+                fh = next(self.fh_counter)
+                self.fhs[fh] = (path, fobj, threading.Lock())
+                self.path_fhs.setdefault(path, set()).add(fh)
             return fh
         except Exception as e:
             self._l(' -> %s' % (e,))
@@ -163,24 +219,29 @@ class Mailfile_Fuse(Operations):
 
     def create(self, path, mode, fi=None):
         self._l('create(%s, %s, %s)' % (path, mode, fi))
-        self.stat_cache[path] = self._make_stat(mode)
+        with self.lock:
+            self.stat_cache[path] = self._make_stat(mode)
         return self.open(path, os.O_WRONLY | os.O_CREAT)
 
     def read(self, path, length, offset, fh):
-        self._l('read(%s, %s, %s, %s)' % (path, length, offset, fh))
+        if self.verbose:
+            self._l('read(%s, %s, %s, %s)' % (path, length, offset, fh))
         try:
-            fd = self.fhs[fh][1]
-            fd.seek(offset)
-            return fd.read(length)
+            path, fd, lock = self._fh(fh)
+            with lock:
+                fd.seek(offset)
+                return fd.read(length)
         except KeyError:
             raise FuseOSError(errno.EBADFD)
 
     def write(self, path, buf, offset, fh):
-        self._l('write(%s, %s, %s, %s)' % (path, buf, offset, fh))
+        if self.verbose:
+            self._l('write(%s, %s, %s, %s)' % (path, buf, offset, fh))
         try:
-            fd = self.fhs[fh][1]
-            fd.seek(offset)
-            fd.write(buf)
+            path, fd, lock = self._fh(fh)
+            with lock:
+                fd.seek(offset)
+                fd.write(buf)
             return len(buf)
         except KeyError:
             raise FuseOSError(errno.EBADFD)
@@ -189,12 +250,17 @@ class Mailfile_Fuse(Operations):
         self._l('truncate(%s, %s, %s)' % (path, length, fh))
         try:
             if fh:
-                fd = self.fhs[fh][1]
-                return fd.truncate(length)
+                path, fd, lock = self._fh(fh)
+                with lock:
+                    return fd.truncate(length)
             else:
-                for fn, fo in self.fhs.values():
-                    if fn == path:
+                with self.lock:
+                    handles = [
+                        self.fhs[h] for h in self.path_fhs.get(path, ())]
+                for fn, fo, lock in handles:
+                    with lock:
                         fo.truncate(length)
+                if handles:
                     return 0
                 fd = self.mailfile.open(path, 'w')
                 fd.truncate(length)
@@ -210,9 +276,18 @@ class Mailfile_Fuse(Operations):
     def release(self, path, fh):
         self._l('release(%s, %s)' % (path, fh))
         try:
-            self.fhs[fh][1].close()  
-            del self.fhs[fh]
-            self.mailfile.synchronize()
+            with self.lock:
+                path, fd, lock = self.fhs.pop(fh)
+                path_fhs = self.path_fhs[path]
+                path_fhs.discard(fh)
+                if not path_fhs:
+                    del self.path_fhs[path]
+            with lock:
+                fd.close()
+            # Only writes change anything on the server; closing a file
+            # which was only read needs no round-trip.
+            if 'w' in fd._open_mode or 'a' in fd._open_mode:
+                self.mailfile.synchronize()
             return 0
         except KeyError as e:
             self._l(' -> ' % (e,))
@@ -223,8 +298,19 @@ class Mailfile_Fuse(Operations):
         return self._l('fsync(%s, %s, %s)' % (path, fdatasync, fh), 0)
 
 
-def mount(mailfile, mountpoint, verbose=False):
+def mount(mailfile, mountpoint, verbose=False, attr_timeout=10.0):
+    """
+    Mount a Mailfile using FUSE. Our getattr() is answered from RAM, so
+    the main cost of a stat is the kernel round-trip itself; attr_timeout
+    sets how many seconds the kernel may cache attributes and names.
+    The default is ten times that of libfuse. Changes made through the
+    mount itself are seen at once, but changes made by other Mailfile
+    clients may take this long to show up.
+
+    Writes only go to RAM until the file is released, so we ask for big
+    writes to cut down on the number of write() upcalls.
+    """
     mailfile.synchronize()
-    FUSE(
-        Mailfile_Fuse(mailfile, verbose), mountpoint,
-        nothreads=True, foreground=True)
+    FUSE(Mailfile_Fuse(mailfile, verbose), mountpoint, foreground=True,
+         attr_timeout=attr_timeout, entry_timeout=attr_timeout,
+         big_writes=True, max_write=(1 << 20))